@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of JSON backends (load/dump) on data files
+
+* times load_json/dumps_json of src/json_codec.py w/ each backend installed
+* dump: compact & pretty (indented)
+
+"""
+
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+import sys
+import timeit
+
+# shared JSON codec in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import json_codec  # noqa: E402
+from json_codec import dumps_json, loads_json  # noqa: E402
+
+
+def measure(func, arg, num_repeats: int) -> float:
+    """return the best time of num_repeats in ms"""
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=num_repeats)) * 1e3
+
+
+def main(args):
+    logging.info(f"Backends: {json_codec.JSON_BACKENDS}")
+
+    for filepath in args.filepaths:
+        raw = filepath.read_bytes()
+        data = loads_json(raw)
+        logging.info(f"[{filepath.name}] {len(raw) / 1e6:.2f} MB")
+        logging.info(
+            f"  {'backend':<8} {'load':>9} {'dump':>9} {'pretty':>9} {'size':>9}"
+        )
+        for name in json_codec.JSON_BACKENDS:
+            # the codec dispatches on JSON_BACKEND at call time
+            json_codec.JSON_BACKEND = name
+
+            # sanity check: round trip
+            assert loads_json(dumps_json(data)) == data
+
+            time_load = measure(loads_json, raw, args.num_repeats)
+            time_dump = measure(dumps_json, data, args.num_repeats)
+            time_pretty = measure(
+                lambda x: dumps_json(x, pretty=True), data, args.num_repeats
+            )
+            size = len(dumps_json(data)) / 1e6
+            logging.info(
+                f"  {name:<8} {time_load:7.1f}ms {time_dump:7.1f}ms "
+                f"{time_pretty:7.1f}ms {size:7.2f}MB"
+            )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Micro-benchmark of JSON backends")
+    parser.add_argument(
+        "--filepaths",
+        type=Path,
+        nargs="+",
+        help="filepaths to JSON data",
+        default=[Path("data/all_v0.json"), Path("data/graphs.json")],
+    )
+    parser.add_argument(
+        "--num_repeats", type=int, help="#repeats, best one is used", default=10
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s:%(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    logging.info(f"Arguments: {vars(args)}")
+
+    main(args)
@@ -0,0 +1,9 @@
+#!/usr/bin/bash
+
+eval "$(conda shell.bash hook)"
+conda activate promqa-cooking
+
+# compare load/dump time of JSON backends
+python src/benchmark/benchmark_json.py \
+    --filepaths data/all_v0.json data/graphs.json \
+    --num_repeats 10
@@ -0,0 +1,117 @@
+"""
+Convert examples, predictions, & evaluations between JSON and tables
+
+* export: JSON files -> examples/predictions/evaluations.{parquet,arrow}
+* import: tables -> JSON, examples joined w/ results of one run
+
+"""
+
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+import sys
+from schema import decode_examples, encode_examples
+from table import FORMATS, to_tables, save_tables, load_table, from_tables
+
+# shared JSON codec in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import load_json, save_json  # noqa: E402
+
+
+def export_tables(args) -> None:
+    run2examples = {}
+    for filepath in args.filepaths_input:
+        run2examples[filepath.stem] = decode_examples(load_json(filepath))
+        logging.info(f"[{filepath.stem}] #examples: {len(run2examples[filepath.stem])}")
+
+    tables = to_tables(run2examples)
+    save_tables(tables, args.dirpath_output, args.format)
+    for name, table in tables.items():
+        logging.info(f"{name}: {table.num_rows} rows, {table.num_columns} columns")
+
+
+def import_tables(args) -> None:
+    tables = {
+        name: load_table(args.dirpath_input, name, args.format)
+        for name in ["examples", "predictions", "evaluations"]
+    }
+    examples, question_id2prediction, question_id2evaluation = from_tables(
+        tables, args.run
+    )
+    if args.run is not None:
+        # only examples in the run
+        question_ids = set(question_id2prediction) | set(question_id2evaluation)
+        examples = [x for x in examples if x.question_id in question_ids]
+
+    outputs = encode_examples(
+        examples,
+        predictions=question_id2prediction,
+        evaluations=question_id2evaluation,
+    )
+    save_json(outputs, args.filepath_output, pretty=args.pretty)
+    logging.info(f"#examples: {len(outputs)}")
+
+
+def main(args):
+    match args.mode:
+        case "export":
+            export_tables(args)
+        case "import":
+            import_tables(args)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Convert between JSON and tables")
+    parser.add_argument(
+        "--mode", type=str, choices=["export", "import"], help="JSON -> tables or back"
+    )
+    parser.add_argument(
+        "--filepaths_input",
+        type=Path,
+        nargs="+",
+        help="[export] filepaths to examples, predictions, or evaluations (JSON)",
+    )
+    parser.add_argument(
+        "--dirpath_output", type=Path, help="[export] dirpath to output tables"
+    )
+    parser.add_argument("--dirpath_input", type=Path, help="[import] dirpath to tables")
+    parser.add_argument(
+        "--run",
+        type=str,
+        help="[import] run to join, i.e., input filename w/o suffix (default: none)",
+        default=None,
+    )
+    parser.add_argument(
+        "--filepath_output", type=Path, help="[import] filepath to JSON"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=list(FORMATS),
+        help="table format",
+        default="parquet",
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
+    parser.add_argument("--dirpath_log", type=Path, help="dirpath for log")
+    args = parser.parse_args()
+
+    if not args.dirpath_log.exists():
+        args.dirpath_log.mkdir(parents=True)
+    if args.dirpath_output and not args.dirpath_output.exists():
+        args.dirpath_output.mkdir(parents=True)
+
+    logging.basicConfig(
+        format="%(asctime)s:%(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO,
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(args.dirpath_log / "convert_table.log"),
+        ],
+    )
+
+    logging.info(f"Arguments: {vars(args)}")
+
+    main(args)
@@ -0,0 +1,15 @@
+#!/usr/bin/bash
+
+eval "$(conda shell.bash hook)"
+conda activate promqa-cooking
+
+# export examples, predictions, & evaluations into tables (parquet)
+dirpath_output=./output/table
+dirpath_log=./log/
+
+python src/benchmark/convert_table.py \
+    --mode export \
+    --filepaths_input "$@" \
+    --dirpath_output "$dirpath_output" \
+    --format parquet \
+    --dirpath_log "$dirpath_log"
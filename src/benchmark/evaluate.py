@@ -5,7 +5,6 @@ Evaluate (LLM-as-a-judge)
 
 from argparse import ArgumentParser
 from collections import defaultdict
-from copy import deepcopy
 import logging
 from pathlib import Path
 import json
@@ -18,7 +17,11 @@ from utils import (
     get_text_content_evaluation,
     call_api,
     estimate_cost,
+    get_feedback_schema,
+    load_json,
+    save_json,
 )
+from schema import Evaluation, decode_examples, encode_examples
 
 
 def parse_feedback(feedback: str) -> tuple[str, str]:
@@ -35,10 +38,34 @@ def parse_feedback(feedback: str) -> tuple[str, str]:
     return judge.strip(), rationale.strip()
 
 
+def parse_feedback_structured(feedback: str, schema: dict) -> tuple[str, str]:
+    """
+    parse & validate feedback of the structured-output mode
+    raise ValueError if the feedback does not follow the schema
+
+    e.g.,
+    {"rationale": "...", "judge": "2"}
+    """
+
+    try:
+        data = json.loads(feedback)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+    if not isinstance(data, dict) or not isinstance(data.get("rationale"), str):
+        raise ValueError(f"No rationale found: {feedback}")
+    judge = str(data.get("judge")).strip()
+    if judge not in schema["properties"]["judge"]["enum"]:
+        raise ValueError(f"Invalid judge: {judge}")
+
+    return judge, data["rationale"].strip()
+
+
 def main(args):
     # load input
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    examples = decode_examples(load_json(args.filepath_input))
+    # results are keyed by question id
+    assert len(set(x.question_id for x in examples)) == len(examples)
 
     # load instruction
     name2recipe = load_recipe(args.filepath_recipe)
@@ -49,8 +76,12 @@ def main(args):
 
     logging.info(f"#target examples: {len(examples)} ({args.template_type=})")
 
+    response_schema = None
+    if args.structured_output:
+        response_schema = get_feedback_schema(args.template_type)
+
     logging.info("Call API")
-    if "human_answer" in examples[0]:
+    if "human_answer" in examples[0].extra:
         filepath_output = (
             args.dirpath_output / f"{Path(args.model_id).name}_{args.template_type}"
             f"_{args.filepath_input.parent.name}_{args.filepath_input.name}"
@@ -60,7 +91,8 @@ def main(args):
             args.dirpath_output
             / f"{Path(args.model_id).name}_{args.template_type}_{args.filepath_input.name}"
         )
-    new_examples = []
+    # question id -> evaluation, joined w/ examples when saved
+    question_id2evaluation = {}
     count_tokens = defaultdict(int)
     for idx, example in tqdm(enumerate(examples), total=len(examples)):
         content, text_prompt = get_text_content_evaluation(
@@ -76,37 +108,51 @@ def main(args):
             logging.info(text_prompt)
         # sys.exit('stop')
 
-        response, _tokens = call_api(
+        # w/ structured output, validate on receipt and retry if invalid
+        for num_trial in range(args.max_retries + 1):
+            response, _tokens = call_api(
+                model_id=args.model_id,
+                content=content,
+                temperature=args.temperature,
+                max_tokens=args.max_tokens,
+                response_schema=response_schema,
+            )
+            count_tokens["input"] += _tokens["input"]
+            count_tokens["output"] += _tokens["output"]
+
+            judge, rationale = None, None
+            try:
+                if response_schema:
+                    judge, rationale = parse_feedback_structured(
+                        response, response_schema
+                    )
+                else:
+                    judge, rationale = parse_feedback(response)
+                break
+            except Exception as e:
+                logging.warning(
+                    f"Error happened during postprocess ({num_trial=}): {e}"
+                )
+                if num_trial < args.max_retries:
+                    time.sleep(args.wait_time)
+
+        # note: judge & rationale are not written if None
+        question_id2evaluation[example.question_id] = Evaluation(
+            prompt=text_prompt,
             model_id=args.model_id,
-            content=content,
-            temperature=args.temperature,
-            max_tokens=args.max_tokens,
+            template_type=args.template_type,
+            response=response,
+            judge=judge,
+            rationale=rationale,
         )
 
-        new_example = deepcopy(example)
-        new_example["evaluation"] = {
-            "prompt": text_prompt,
-            "model_id": args.model_id,
-            "template_type": args.template_type,
-            "response": response,
-        }
-        try:
-            judge, rationale = parse_feedback(response)
-            new_example["evaluation"]["judge"] = judge
-            new_example["evaluation"]["rationale"] = rationale
-        except Exception as e:
-            logging.warning(f"Error happened during postprocess: {e}")
-        new_examples.append(new_example)
-
-        count_tokens["input"] += _tokens["input"]
-        count_tokens["output"] += _tokens["output"]
-
-        with open(filepath_output, "w") as f:
-            json.dump(new_examples, f, indent=4)
-            f.write("\n")
+        outputs = encode_examples(
+            examples[: idx + 1], evaluations=question_id2evaluation
+        )
+        save_json(outputs, filepath_output, pretty=args.pretty)
         time.sleep(args.wait_time)
 
-    assert len(examples) == len(new_examples)
+    assert len(examples) == len(question_id2evaluation)
 
     cost = estimate_cost(args.model_id, count_tokens)
     logging.info(f"Estimated cost: ${cost:.4f}.")
@@ -125,6 +171,20 @@ if __name__ == "__main__":
         "--max_tokens", type=int, help="max tokens to generate", default=256
     )
     parser.add_argument("--wait_time", type=int, help="API call wait time", default=0.5)
+    parser.add_argument(
+        "--structured_output",
+        action="store_true",
+        help="request JSON output following a schema (rationale & judge)",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        help="max #retries for an invalid response",
+        default=0,
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="dirpath to log")
 
     args = parser.parse_args()
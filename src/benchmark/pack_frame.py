@@ -0,0 +1,121 @@
+"""
+Pack sampled frames (<recording_id>/%d.png) into one file per recording
+
+"""
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from functools import partial
+import json
+import logging
+import multiprocessing
+from pathlib import Path
+import sys
+from tqdm import tqdm
+
+# shared modules in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils_frame import (  # noqa: E402
+    PACK_MAGIC,
+    PACK_FOOTER,
+    FrameArchive,
+    extract_index,
+)
+
+
+def pack_frames(dirpath_frame: Path, filepath_output: Path) -> int:
+    """
+    write frames of one recording as
+    PACK_MAGIC | png | png | ... | index | footer
+
+    """
+    filepaths = sorted(dirpath_frame.glob("*.png"), key=extract_index)
+
+    # write to a temporary file first not to leave a broken archive
+    filepath_tmp = filepath_output.with_suffix(".pack.tmp")
+    index = {}
+    with open(filepath_tmp, "wb") as f:
+        f.write(PACK_MAGIC)
+        for filepath in filepaths:
+            data = filepath.read_bytes()
+            index[extract_index(filepath)] = [f.tell(), len(data)]
+            f.write(data)
+        offset = f.tell()
+        raw_index = json.dumps(index).encode("utf-8")
+        f.write(raw_index)
+        f.write(PACK_FOOTER.pack(offset, len(raw_index), PACK_MAGIC))
+    filepath_tmp.replace(filepath_output)
+
+    return len(filepaths)
+
+
+def worker_function(dirpath_frame, dirpath_output):
+    status = 0
+    filepath_output = dirpath_output / f"{dirpath_frame.name}.pack"
+    try:
+        num_frames = pack_frames(dirpath_frame, filepath_output)
+        # sanity check
+        archive = FrameArchive(filepath_output)
+        assert len(archive.frame_ids()) == num_frames
+    except Exception as e:
+        logging.error(f"In worker_function(): {dirpath_frame.name} {e}")
+        status = 1
+
+    return status
+
+
+def main(args):
+    dirpaths_frame = [x for x in args.dirpath_input.iterdir() if x.is_dir()]
+    logging.info(f"#recording: {len(dirpaths_frame)}")
+
+    results = []
+    with multiprocessing.Pool(processes=args.max_parallel_jobs) as pool:
+        results = list(
+            tqdm(
+                pool.imap_unordered(
+                    partial(worker_function, dirpath_output=args.dirpath_output),
+                    dirpaths_frame,
+                ),
+                total=len(dirpaths_frame),
+            )
+        )
+
+    count = defaultdict(int)
+    for status in results:
+        if status == 0:
+            count["success"] += 1
+        else:
+            count["failure"] += 1
+    logging.info(f"[count] success: {count['success']}, failure: {count['failure']}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Pack frames")
+    parser.add_argument(
+        "--dirpath_input", type=Path, help="dirpath to frames, e.g., frames/360p"
+    )
+    parser.add_argument("--dirpath_output", type=Path, help="dirpath to output")
+    parser.add_argument(
+        "--max_parallel_jobs", type=int, help="max #parallel jobs", default=4
+    )
+    parser.add_argument("--dirpath_log", type=Path, help="dirpath for log")
+    args = parser.parse_args()
+
+    if not args.dirpath_log.exists():
+        args.dirpath_log.mkdir(parents=True)
+    if not args.dirpath_output.exists():
+        args.dirpath_output.mkdir(parents=True)
+
+    logging.basicConfig(
+        format="%(asctime)s:%(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO,
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(args.dirpath_log / "pack_frame.log"),
+        ],
+    )
+
+    logging.info(f"Arguments: {vars(args)}")
+
+    main(args)
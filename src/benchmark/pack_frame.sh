@@ -0,0 +1,17 @@
+#!/usr/bin/bash
+
+eval "$(conda shell.bash hook)"
+conda activate promqa-cooking
+
+# pack frames into one file per recording
+dirpath_input=$1
+dirpath_output=$2
+dirpath_log=./log/
+
+max_parallel_jobs=4
+
+python src/benchmark/pack_frame.py \
+    --dirpath_input "$dirpath_input" \
+    --dirpath_output "$dirpath_output" \
+    --max_parallel_jobs $max_parallel_jobs \
+    --dirpath_log $dirpath_log
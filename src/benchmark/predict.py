@@ -4,9 +4,7 @@ Predict answers from each set of a video (images), a recipe, and a question.
 """
 
 from argparse import ArgumentParser
-from copy import deepcopy
 from collections import defaultdict
-import json
 import logging
 from pathlib import Path
 import time
@@ -19,33 +17,47 @@ from utils import (
     get_image_content,
     call_api,
     estimate_cost,
+    load_json,
+    save_json,
     # save_data,
 )
+from schema import Prediction, decode_examples, encode_examples
 
 
 def main(args):
     # load input
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    examples = decode_examples(load_json(args.filepath_input))
+    # results are keyed by question id
+    assert len(set(x.question_id for x in examples)) == len(examples)
 
     # load instruction
     name2recipe = load_recipe(args.filepath_recipe)
 
+    # sampling & #dropped frames are saved only if either is used, so that
+    # predictions of the default (uniform, no dedup) keep the original keys
+    w_sampling = args.sampling == "adaptive" or args.dedup_threshold is not None
+    frames = str(args.max_frames)
+    if args.sampling == "adaptive":
+        frames += "-adaptive"
+    if args.dedup_threshold is not None:
+        frames += f"-dedup{args.dedup_threshold}"
     filepath_output = (
         args.dirpath_output
-        / f"{Path(args.model_id).name}_{args.max_frames}_{args.filepath_input.name}"
+        / f"{Path(args.model_id).name}_{frames}_{args.filepath_input.name}"
     )
 
     # create input & call api
     logging.info("Start inference")
-    new_examples = []
+    # question id -> prediction, joined w/ examples when saved
+    question_id2prediction = {}
     count_tokens = defaultdict(int)
+    count_dropped = 0
     for idx, example in tqdm(enumerate(examples), total=len(examples)):
         content, text_prompt = get_text_content(
             model_id=args.model_id,
-            recipe=name2recipe[example["activity_name"]]["dot"],
-            name=example["activity_name"],
-            question=example["question"],
+            recipe=name2recipe[example.activity_name]["dot"],
+            name=example.activity_name,
+            question=example.question,
         )
 
         if idx == 0:  # sanity check
@@ -59,9 +71,14 @@ def main(args):
 
         logging.info("Prepare image content")
         # load user recording as frames
-        filepaths_image, ids_image, rate_inverse = load_frame(
-            example, args.dirpath_image, args.max_frames
+        filepaths_image, ids_image, rate_inverse, num_dropped = load_frame(
+            example,
+            args.dirpath_image,
+            args.max_frames,
+            args.sampling,
+            args.dedup_threshold,
         )
+        count_dropped += num_dropped
         content += get_image_content(
             model_id=args.model_id,
             image_paths=filepaths_image,
@@ -74,16 +91,16 @@ def main(args):
             max_tokens=args.max_tokens,
         )
 
-        new_example = deepcopy(example)
-        new_example["prediction"] = {
-            "prompt": text_prompt,
-            "frame_ids": ids_image,
-            "rate_inverse": rate_inverse,
-            "dirpath_images": str(args.dirpath_image),
-            "model_id": args.model_id,
-            "response": response,
-        }
-        new_examples.append(new_example)
+        question_id2prediction[example.question_id] = Prediction(
+            prompt=text_prompt,
+            frame_ids=ids_image,
+            rate_inverse=rate_inverse,
+            sampling=args.sampling if w_sampling else None,
+            num_dropped_frames=num_dropped if w_sampling else None,
+            dirpath_images=str(args.dirpath_image),
+            model_id=args.model_id,
+            response=response,
+        )
 
         count_tokens["input"] += _tokens["input"]
         count_tokens["output"] += _tokens["output"]
@@ -93,12 +110,15 @@ def main(args):
             for _content in content[1:]:
                 _content.delete()
 
-        with open(filepath_output, "w") as f:
-            json.dump(new_examples, f, indent=4)
-            f.write("\n")
+        outputs = encode_examples(
+            examples[: idx + 1], predictions=question_id2prediction
+        )
+        save_json(outputs, filepath_output, pretty=args.pretty)
         time.sleep(args.wait_time)
 
-    logging.info(f"#target examples: {len(new_examples)}/{len(examples)}")
+    logging.info(f"#target examples: {len(question_id2prediction)}/{len(examples)}")
+    if args.dedup_threshold is not None:
+        logging.info(f"#dropped duplicate frames: {count_dropped}")
     cost = estimate_cost(args.model_id, count_tokens)
     logging.info(f"Estimated cost: ${cost:.4f}.")
 
@@ -115,7 +135,23 @@ if __name__ == "__main__":
         "--max_tokens", type=int, help="max tokens to generate", default=1024
     )
     parser.add_argument("--max_frames", type=int, help="max frames to feed", default=20)
+    parser.add_argument(
+        "--sampling",
+        type=str,
+        choices=["uniform", "adaptive"],
+        help="frame sampling (adaptive: more frames around scene changes)",
+        default="uniform",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=int,
+        help="collapse near-duplicate frames within this hamming distance (e.g., 4)",
+        default=None,
+    )
     parser.add_argument("--wait_time", type=int, help="API call wait time", default=10)
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="dirpath for log")
 
     args = parser.parse_args()
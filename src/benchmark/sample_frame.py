@@ -6,10 +6,30 @@ Preprocess videos and sample frames
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
+from PIL import Image
 from tqdm import tqdm
 import subprocess
 import multiprocessing
 from collections import defaultdict
+from functools import partial
+import hashlib
+import numpy as np
+import os
+import sys
+import time
+
+# shared modules in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import load_json, save_json  # noqa: E402
+from utils_frame import (  # noqa: E402
+    convert_time,
+    extract_index,
+    sample_frame_ids,
+    compute_signatures,
+    compute_phashes,
+    SIGNATURE_SIZE,
+    PHASH_SIZE,
+)
 
 CONFIGS_FRAMES = [
     ["640", "360"],
@@ -21,67 +41,512 @@ CONFIGS_SAMPLING = {
     "resolution": ["3840", "2160"],
 }
 
+# hardware decoders, in order of preference
+HWACCELS = ["cuda", "vaapi"]
 
-def worker_function(command):
-    status = 0
+# #inputs (frames) per targeted extraction command, i.e., #decoders opened at
+# once; fewer w/ hw decoding, as hw decoder sessions are limited (e.g., NVDEC)
+CHUNK_SIZE_TARGETING = {"none": 32, "hw": 4}
+
+
+def run_command(command, num_lines=20):
+    """run one command, return exit code & the last lines of stderr"""
+    try:
+        result = subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        stderr = result.stderr.decode(errors="replace")
+        returncode = result.returncode
+    except Exception as e:
+        stderr, returncode = str(e), -1
+    return returncode, "\n".join(stderr.strip().splitlines()[-num_lines:])
+
+
+def worker_function(job, max_retries=2, backoff=5.0):
+    """
+    run all commands of one recording
+    * a failed command is retried up to max_retries times w/ exponential backoff
+    * the last retry falls back to software decoding (if hw decoding is used)
+    * every failed attempt is recorded w/ its exit code, stderr tail, time, and
+      decoder (hwaccel, i.e., cuda, vaapi, or none)
+
+    """
+    recording_id, commands, commands_cpu, hwaccel = job
+    start = time.perf_counter()
+    status, attempts = 0, []
+    for idx, command in enumerate(commands):
+        for num_trial in range(max_retries + 1):
+            decoder = hwaccel
+            if num_trial == max_retries and num_trial > 0 and commands_cpu:
+                command, decoder = commands_cpu[idx], "none"
+            _start = time.perf_counter()
+            returncode, stderr = run_command(command)
+            if returncode == 0:
+                break
+            attempts.append(
+                {
+                    "command": idx,
+                    "trial": num_trial,
+                    "decoder": decoder,
+                    "returncode": returncode,
+                    "elapsed": time.perf_counter() - _start,
+                    "stderr": stderr,
+                }
+            )
+            logging.warning(
+                f"[{recording_id}] command {idx} failed "
+                f"(trial: {num_trial}, returncode: {returncode})"
+            )
+            if num_trial < max_retries:
+                time.sleep(backoff * 2**num_trial)
+        else:
+            status = returncode
+
+    return recording_id, {
+        "status": status,
+        "elapsed": time.perf_counter() - start,
+        "num_commands": len(commands),
+        "attempts": attempts,
+    }
+
+
+def probe_duration(filepath):
+    """get video duration (second) w/ ffprobe, 0 if failed"""
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=duration"]
+    command += ["-of", "default=noprint_wrappers=1:nokey=1", str(filepath)]
     try:
         result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            text=True,
+        )
+        return float(result.stdout.strip())
+    except Exception as e:
+        logging.error(f"In probe_duration(): {filepath.name} {e}")
+        return 0.0
+
+
+def get_durations(filepaths, filepath_cache):
+    """
+    return mapping from video filepath to duration
+    * cached by filename, size & mtime
+
+    """
+    cache = {}
+    if filepath_cache.exists():
+        cache = load_json(filepath_cache)
+
+    filepath2duration = {}
+    for filepath in tqdm(filepaths, desc="probe duration"):
+        stat = filepath.stat()
+        key = [stat.st_size, stat.st_mtime]
+        if filepath.name in cache and cache[filepath.name]["key"] == key:
+            duration = cache[filepath.name]["duration"]
+        else:
+            duration = probe_duration(filepath)
+            if duration > 0:
+                cache[filepath.name] = {"key": key, "duration": duration}
+        filepath2duration[filepath] = duration
+
+    save_json(cache, filepath_cache)
+
+    return filepath2duration
+
+
+def load_manifest(filepath):
+    """
+    load job manifest: recording id -> source, config, and outputs
+    * source: size & mtime of the video
+    * config: fps, resolutions, codec (& frame ids if targeted)
+    * outputs: #frames & checksum for each resolution
+
+    """
+    if not filepath.exists():
+        return {}
+    return load_json(filepath)
+
+
+def save_json_atomic(data, filepath):
+    """save json via a temporary file, not to leave a broken file if killed"""
+    filepath_tmp = filepath.with_suffix(".tmp")
+    save_json(data, filepath_tmp)
+    filepath_tmp.replace(filepath)
+
+
+def get_job_state(filepath, frame_ids=None):
+    """source & config of one recording, to check if outputs are up to date"""
+    stat = filepath.stat()
+    return {
+        "source": {"size": stat.st_size, "mtime": stat.st_mtime},
+        "config": {
+            "fps": CONFIGS_SAMPLING["fps"],
+            "resolutions": [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES,
+            "codec": "png",
+            "frame_ids": sorted(frame_ids) if frame_ids is not None else None,
+        },
+    }
+
+
+def get_outputs(dirpath_output, recording_id):
+    """
+    #frames & checksum of output frames for each resolution
+    note: checksum is over file names & sizes, not contents, to keep it cheap
+
+    """
+    outputs = {}
+    for width, height in [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES:
+        dirpath_frame = dirpath_output / f"{height}p" / recording_id
+        filepaths = sorted(dirpath_frame.glob("*.png"), key=extract_index)
+        checksum = hashlib.sha1()
+        for filepath in filepaths:
+            checksum.update(f"{filepath.name}:{filepath.stat().st_size};".encode())
+        outputs[f"{height}p"] = {
+            "num_frames": len(filepaths),
+            "checksum": checksum.hexdigest(),
+        }
+    return outputs
+
+
+def check_up_to_date(entry, state, dirpath_output, recording_id):
+    """check if a finished job has the same source, config, and outputs"""
+    return (
+        entry is not None
+        and entry["status"] == "done"
+        and entry["source"] == state["source"]
+        and entry["config"] == state["config"]
+        and entry["outputs"] == get_outputs(dirpath_output, recording_id)
+    )
+
+
+def check_hwaccel(hwaccel, filepath):
+    """check if the first second of a video can be decoded w/ hwaccel"""
+    command = ["ffmpeg", "-v", "error", "-hwaccel", hwaccel, "-t", "1"]
+    command += ["-i", str(filepath), "-f", "null", "-"]
+    try:
+        subprocess.run(
             command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
         )
-        if result.returncode != 0 and status == 0:
-            status = result.returncode
+    except Exception:
+        return False
+    return True
+
+
+def probe_hwaccel(filepath):
+    """
+    pick an available decoder: cuda -> vaapi -> none (software)
+
+    """
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            text=True,
+        )
+        available = result.stdout.split()
     except Exception as e:
-        logging.error(f"In worker_function(): {e}")
-        if status == 0:
-            status = 1
+        logging.error(f"In probe_hwaccel(): {e}")
+        available = []
 
-    return status
+    for hwaccel in HWACCELS:
+        if hwaccel in available and check_hwaccel(hwaccel, filepath):
+            return hwaccel
+
+    return "none"
 
 
-def create_command_frame_sampling(filepath, dirpath_output):
+def get_threads_per_job(max_parallel_jobs):
+    """split cores over parallel jobs to avoid oversubscription"""
+    return max(1, (os.cpu_count() or 1) // max_parallel_jobs)
+
+
+def create_command_frame_sampling(filepath, dirpath_output, hwaccel="cuda", threads=0):
+    """
+    decode a video once and write frames in all resolutions
+    * CONFIGS_SAMPLING["resolution"]: as is
+    * CONFIGS_FRAMES: split & scale the same decoded frames
+    * hwaccel: cuda, vaapi, or none (software decoding w/ `threads` threads)
+    * threads: 0 lets ffmpeg decide
+
+    """
     fps = CONFIGS_SAMPLING["fps"]
-    width, height = CONFIGS_SAMPLING["resolution"]
     recording_id = filepath.stem.replace("_4K", "")
-    filepath_output = dirpath_output / f"{height}p" / recording_id / "%d.png"
-    if not filepath_output.parent.exists():
-        filepath_output.parent.mkdir(parents=True)
+    resolutions = [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES
+
+    filepaths_output = []
+    for width, height in resolutions:
+        filepath_output = dirpath_output / f"{height}p" / recording_id / "%d.png"
+        if not filepath_output.parent.exists():
+            filepath_output.parent.mkdir(parents=True)
+        filepaths_output.append(filepath_output)
+
+    # e.g., [0:v]fps=1,split=2[v0][v1];[v1]scale=640:360[s1]
+    filters = [
+        f"[0:v]fps={fps},split={len(resolutions)}"
+        + "".join(f"[v{idx}]" for idx in range(len(resolutions)))
+    ]
+    labels = ["[v0]"]
+    for idx, (width, height) in enumerate(CONFIGS_FRAMES, start=1):
+        filters.append(f"[v{idx}]scale={width}:{height}[s{idx}]")
+        labels.append(f"[s{idx}]")
 
     # note: option order matters
-    command = [
-        "ffmpeg",
-        "-y",
-        "-hwaccel",
-        "cuda",
+    command = ["ffmpeg", "-y"]
+    if hwaccel != "none":
+        command += ["-hwaccel", hwaccel]
+    command += [
+        "-threads",
+        str(threads),
         "-i",
         str(filepath),
-        "-vf",
-        f"fps={fps}",
-        filepath_output,
+        "-filter_complex_threads",
+        str(threads),
+        "-filter_complex",
+        ";".join(filters),
     ]
+    for label, filepath_output in zip(labels, filepaths_output):
+        command += ["-map", label, str(filepath_output)]
 
     return command
 
 
-def sample_frames(dirpath_input, dirpath_output, max_parallel_jobs):
+def get_target_frame_ids(filepath_example, max_frames_list):
+    """
+    return mapping from recording id to frame ids that load_frame() samples
+    for any of max_frames_list, i.e., union over examples & max_frames
+
+    note:
+    * frame id k (1-origin, as %d.png) is the frame at k-1 seconds (1 fps)
+
+    """
+    examples = load_json(filepath_example)
+
+    recording_id2frame_ids = defaultdict(set)
+    for example in examples:
+        num_frames = convert_time(example["end_time"])
+        for max_frames in max_frames_list:
+            frame_ids, _ = sample_frame_ids(num_frames, max_frames)
+            recording_id2frame_ids[example["recording_id"]].update(frame_ids)
+
+    return recording_id2frame_ids
+
+
+def create_commands_frame_targeting(
+    filepath, dirpath_output, frame_ids, hwaccel="cuda", threads=0
+):
+    """
+    seek to & decode only target frames, in all resolutions
+    * one input (w/ fast seek) per frame, CHUNK_SIZE_TARGETING frames per command
+    * threads: budget of the whole command, i.e., for filtering; each input
+      decodes one frame w/ one thread, so that inputs do not multiply it
+
+    """
+    chunk_size = CHUNK_SIZE_TARGETING["none" if hwaccel == "none" else "hw"]
+    fps = CONFIGS_SAMPLING["fps"]
+    recording_id = filepath.stem.replace("_4K", "")
+    resolutions = [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES
+
+    dirpaths_frame = []
+    for width, height in resolutions:
+        dirpath_frame = dirpath_output / f"{height}p" / recording_id
+        if not dirpath_frame.exists():
+            dirpath_frame.mkdir(parents=True)
+        dirpaths_frame.append(dirpath_frame)
+
+    frame_ids = sorted(frame_ids)
+    commands = []
+    for start in range(0, len(frame_ids), chunk_size):
+        _frame_ids = frame_ids[start : start + chunk_size]
+
+        command = ["ffmpeg", "-y"]
+        for frame_id in _frame_ids:
+            if hwaccel != "none":
+                command += ["-hwaccel", hwaccel]
+            command += ["-threads", "1"]
+            command += ["-ss", str((frame_id - 1) / fps), "-i", str(filepath)]
+
+        # e.g., [0:v]split=2[v0_0][v0_1];[v0_1]scale=640:360[s0_1]
+        filters, outputs = [], []
+        for idx, frame_id in enumerate(_frame_ids):
+            filters.append(
+                f"[{idx}:v]split={len(resolutions)}"
+                + "".join(f"[v{idx}_{x}]" for x in range(len(resolutions)))
+            )
+            outputs.append((f"[v{idx}_0]", dirpaths_frame[0] / f"{frame_id}.png"))
+            for x, (width, height) in enumerate(CONFIGS_FRAMES, start=1):
+                filters.append(f"[v{idx}_{x}]scale={width}:{height}[s{idx}_{x}]")
+                outputs.append((f"[s{idx}_{x}]", dirpaths_frame[x] / f"{frame_id}.png"))
+
+        command += ["-filter_complex_threads", str(threads)]
+        command += ["-filter_complex", ";".join(filters)]
+        for label, filepath_output in outputs:
+            command += ["-map", label, "-frames:v", "1", "-update", "1"]
+            command.append(str(filepath_output))
+        commands.append(command)
+
+    return commands
+
+
+def sample_frames(
+    dirpath_input,
+    dirpath_output,
+    max_parallel_jobs,
+    hwaccel="auto",
+    threads_per_job=None,
+    recording_id2frame_ids=None,
+    force=False,
+    only_failed=False,
+    max_retries=2,
+    backoff=5.0,
+):
+    """
+    sample frames of each video
+    * recordings up to date in the manifest are skipped (unless force)
+    * interrupted recordings are re-run (only missing frames if targeted)
+    * only_failed: only re-run recordings marked as failed in the manifest
+    * per-recording results (incl. failed attempts) are saved in results.json
+
+    """
     # frame sampling
     if not dirpath_output.exists():
         dirpath_output.mkdir(parents=True)
 
-    commands = []
+    filepath_manifest = dirpath_output / "manifest.json"
+    # loaded even w/ force, for only_failed & to keep the other recordings
+    manifest = load_manifest(filepath_manifest)
+    filepath_results = dirpath_output / "results.json"
+    results_table = load_json(filepath_results) if filepath_results.exists() else {}
+
+    filepaths = list(dirpath_input.glob("*.mp4"))
+    if hwaccel == "auto" and filepaths:
+        hwaccel = probe_hwaccel(filepaths[0])
+    if threads_per_job is None:
+        # hw decoding needs few cpu threads, so let ffmpeg decide
+        threads_per_job = (
+            get_threads_per_job(max_parallel_jobs) if hwaccel == "none" else 0
+        )
+    logging.info(f"[decoder] hwaccel: {hwaccel}, threads per job: {threads_per_job}")
+
+    jobs, states, durations = [], {}, {}
     count = defaultdict(int)
-    for filepath in args.dirpath_input.glob("*.mp4"):
+    filepath2duration = get_durations(filepaths, dirpath_output / "durations.json")
+    # longest first, so that a long recording does not keep the pool waiting at last
+    filepaths = sorted(filepaths, key=lambda x: filepath2duration[x], reverse=True)
+    for filepath in filepaths:
+        recording_id = filepath.stem.replace("_4K", "")
+        if recording_id2frame_ids is None:
+            frame_ids = None
+        elif recording_id in recording_id2frame_ids:
+            frame_ids = recording_id2frame_ids[recording_id]
+        else:
+            count["skip"] += 1
+            continue
+
+        if only_failed and manifest.get(recording_id, {}).get("status") != "failed":
+            count["skip"] += 1
+            continue
+
+        state = get_job_state(filepath, frame_ids)
+        if not force and check_up_to_date(
+            manifest.get(recording_id), state, dirpath_output, recording_id
+        ):
+            count["up-to-date"] += 1
+            continue
+        states[recording_id] = state
         count["total"] += 1
-        command = create_command_frame_sampling(filepath, dirpath_output)
-        commands.append(command)
 
-    logging.info(f"#command: {len(commands)}")
+        # software decoding, as a fallback for hw decoding failures
+        commands_cpu = None
+        if frame_ids is None:
+            commands = [
+                create_command_frame_sampling(
+                    filepath, dirpath_output, hwaccel, threads_per_job
+                )
+            ]
+            if hwaccel != "none":
+                commands_cpu = [
+                    create_command_frame_sampling(
+                        filepath,
+                        dirpath_output,
+                        "none",
+                        get_threads_per_job(max_parallel_jobs),
+                    )
+                ]
+        else:
+            # targeted extraction: only frames used by the benchmark & not yet done
+            frame_ids = [
+                x
+                for x in frame_ids
+                if not all(
+                    (dirpath_output / f"{h}p" / recording_id / f"{x}.png").exists()
+                    for _, h in [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES
+                )
+            ]
+            count["frame"] += len(frame_ids)
+            commands = create_commands_frame_targeting(
+                filepath,
+                dirpath_output,
+                frame_ids,
+                hwaccel,
+                threads_per_job,
+            )
+            if hwaccel != "none":
+                commands_cpu = create_commands_frame_targeting(
+                    filepath,
+                    dirpath_output,
+                    frame_ids,
+                    "none",
+                    get_threads_per_job(max_parallel_jobs),
+                )
+        jobs.append((recording_id, commands, commands_cpu, hwaccel))
+        durations[recording_id] = filepath2duration[filepath]
+
+    logging.info(f"#command: {sum(len(x[1]) for x in jobs)}")
     logging.info(f"#recording: {dict(count)}")
 
-    results = []
+    remaining = sum(durations.values())
+    logging.info(f"total duration: {remaining / 3600:.2f} hours")
+
+    results, recording_ids_done = [], []
+    start = time.perf_counter()
+    processed = 0.0
     with multiprocessing.Pool(processes=max_parallel_jobs) as pool:
-        results = list(
-            tqdm(pool.imap_unordered(worker_function, commands), total=len(commands))
-        )
+        for recording_id, result in tqdm(
+            pool.imap_unordered(
+                partial(worker_function, max_retries=max_retries, backoff=backoff),
+                jobs,
+            ),
+            total=len(jobs),
+        ):
+            status, elapsed = result["status"], result["elapsed"]
+            results.append(status)
+            if status == 0:
+                recording_ids_done.append(recording_id)
+            results_table[recording_id] = result
+            save_json_atomic(results_table, filepath_results)
+            # throughput: seconds of video per second; eta based on overall rate
+            processed += durations[recording_id]
+            remaining -= durations[recording_id]
+            rate = processed / (time.perf_counter() - start)
+            logging.info(
+                f"[{recording_id}] status: {status}, "
+                f"duration: {durations[recording_id]:.0f}s, elapsed: {elapsed:.0f}s, "
+                f"throughput: {durations[recording_id] / max(elapsed, 1e-6):.1f}x, "
+                f"eta: {remaining / rate / 60 if rate > 0 else 0:.1f} min"
+            )
+            # record each job as soon as it finishes
+            manifest[recording_id] = states[recording_id] | {
+                "status": "done" if status == 0 else "failed",
+                "outputs": get_outputs(dirpath_output, recording_id),
+            }
+            save_json_atomic(manifest, filepath_manifest)
+
+    # signatures for adaptive frame sampling
+    if recording_ids_done:
+        build_frame_index(recording_ids_done, dirpath_output, max_parallel_jobs)
 
     count = defaultdict(int)
     for status in results:
@@ -90,32 +555,124 @@ def sample_frames(dirpath_input, dirpath_output, max_parallel_jobs):
         else:
             count["failure"] += 1
     logging.info(f"[count] success: {count['success']}, failure: {count['failure']}")
+    for recording_id, result in results_table.items():
+        if result["status"] != 0 and result["attempts"]:
+            attempt = result["attempts"][-1]
+            logging.error(
+                f"[failed] {recording_id}: returncode {attempt['returncode']}, "
+                f"stderr: {attempt['stderr'].splitlines()[-1:]}"
+            )
 
     return count
 
 
-def create_command_frame_resolution(filepath, dirpath_output):
-    commands = []
-    for width, height in CONFIGS_FRAMES:
-        filepath_output = (
-            dirpath_output / f"{height}p" / filepath.parent.name / filepath.name
-        )
-        if not filepath_output.parent.exists():
-            filepath_output.parent.mkdir(parents=True)
+def index_worker_function(recording_id, dirpath_output):
+    """
+    build the frame index of one recording (see load_frame() in utils.py)
+    * a separate pass after extraction, since ffmpeg decodes frames out of
+      process, i.e., decoded frames are not available here
+    * signatures & phashes are computed from the smallest frames, the fastest
+      to decode
+    * saved as <height>p/<recording_id>.index.npz for each resolution
 
-        # kh: option order matters
-        command = [
-            "ffmpeg",
-            "-y",
-            "-i",
-            str(filepath),
-            "-vf",
-            f"scale={width}:{height}",
-            str(filepath_output),
+    """
+    status = 0
+    try:
+        dirpaths_frame = [
+            dirpath_output / f"{height}p" / recording_id
+            for _, height in [CONFIGS_SAMPLING["resolution"]] + CONFIGS_FRAMES
         ]
-        commands.append(command)
+        dirpaths_frame = [x for x in dirpaths_frame if x.exists()]
+        dirpath_source = min(dirpaths_frame, key=lambda x: int(x.parent.name[:-1]))
+        filepaths = sorted(dirpath_source.glob("*.png"), key=extract_index)
+        if not filepaths:
+            return status
+
+        images, images_phash = [], []
+        for filepath in filepaths:
+            with Image.open(filepath) as image:
+                image = image.convert("L")
+                images.append(
+                    np.asarray(image.resize(SIGNATURE_SIZE, Image.Resampling.BOX))
+                )
+                images_phash.append(
+                    np.asarray(
+                        image.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX)
+                    )
+                )
+        frame_index = {
+            "frame_ids": np.array([extract_index(x) for x in filepaths]),
+            "signatures": compute_signatures(np.stack(images)),
+            "phashes": compute_phashes(np.stack(images_phash)),
+        }
+
+        for dirpath_frame in dirpaths_frame:
+            filepath_index = dirpath_frame.parent / f"{recording_id}.index.npz"
+            filepath_tmp = filepath_index.with_suffix(".tmp")
+            with open(filepath_tmp, "wb") as f:
+                np.savez(f, **frame_index)
+            filepath_tmp.replace(filepath_index)
+    except Exception as e:
+        logging.error(f"In index_worker_function(): {recording_id} {e}")
+        status = 1
 
-    return commands
+    return status
+
+
+def build_frame_index(recording_ids, dirpath_output, max_parallel_jobs):
+    logging.info(f"Build frame index ... (#recording: {len(recording_ids)})")
+    with multiprocessing.Pool(processes=max_parallel_jobs) as pool:
+        results = list(
+            tqdm(
+                pool.imap_unordered(
+                    partial(index_worker_function, dirpath_output=dirpath_output),
+                    recording_ids,
+                ),
+                total=len(recording_ids),
+            )
+        )
+    logging.info(f"[count] index failure: {sum(x != 0 for x in results)}")
+
+
+def resize_worker_function(folderpath, dirpath_output):
+    """
+    resize all frames of one recording in-process (w/o spawning ffmpeg)
+    * each frame is decoded once for all CONFIGS_FRAMES
+    * Pillow-SIMD, if installed instead of Pillow, accelerates resizing
+
+    """
+    start = time.perf_counter()
+    status, num_frames = 0, 0
+    try:
+        dirpaths_frame = []
+        for width, height in CONFIGS_FRAMES:
+            dirpath_frame = dirpath_output / f"{height}p" / folderpath.name
+            if not dirpath_frame.exists():
+                dirpath_frame.mkdir(parents=True)
+            dirpaths_frame.append(((int(width), int(height)), dirpath_frame))
+
+        for filepath in folderpath.glob("*.png"):
+            # skip if all outputs are newer than the input
+            mtime = filepath.stat().st_mtime
+            if all(
+                (x / filepath.name).exists()
+                and (x / filepath.name).stat().st_mtime >= mtime
+                for _, x in dirpaths_frame
+            ):
+                continue
+            with Image.open(filepath) as image:
+                image.load()
+                for size, dirpath_frame in dirpaths_frame:
+                    # reducing_gap: box-reduce first, then bicubic (fast for 4K)
+                    image.resize(size, Image.Resampling.BICUBIC, reducing_gap=3.0).save(
+                        dirpath_frame / filepath.name
+                    )
+            num_frames += 1
+    except Exception as e:
+        logging.error(f"In resize_worker_function(): {folderpath.name} {e}")
+        status = 1
+
+    return status, num_frames, time.perf_counter() - start
 
 
 def change_frame_resolution(dirpath_input, dirpath_output, max_parallel_jobs):
@@ -124,28 +681,41 @@ def change_frame_resolution(dirpath_input, dirpath_output, max_parallel_jobs):
     if not dirpath_output.exists():
         dirpath_output.mkdir(parents=True)
 
-    commands = []
-    for folderpath in (dirpath_input / "2160p").glob("*_*"):
-        for filepath in folderpath.glob("*.png"):
-            command = create_command_frame_resolution(filepath, dirpath_output)
-            commands.extend(command)
-
-    logging.info(f"#command: {len(commands)}")
+    folderpaths = list((dirpath_input / "2160p").glob("*_*"))
+    logging.info(f"#recording: {len(folderpaths)}")
 
+    start = time.perf_counter()
     results = []
     with multiprocessing.Pool(processes=max_parallel_jobs) as pool:
         results = list(
-            tqdm(pool.imap_unordered(worker_function, commands), total=len(commands))
+            tqdm(
+                pool.imap_unordered(
+                    partial(resize_worker_function, dirpath_output=dirpath_output),
+                    folderpaths,
+                ),
+                total=len(folderpaths),
+            )
         )
+    elapsed = time.perf_counter() - start
 
     count = defaultdict(int)
-    for status in results:
+    for status, num_frames, _ in results:
         if status == 0:
             count["success"] += 1
         else:
             count["failure"] += 1
+        count["frame"] += num_frames
     logging.info(f"[count] success: {count['success']}, failure: {count['failure']}")
 
+    # throughput per core, to size max_parallel_jobs
+    busy = sum(x[2] for x in results)
+    if busy > 0 and elapsed > 0:
+        logging.info(
+            f"[throughput] #frame: {count['frame']}, "
+            f"total: {count['frame'] / elapsed:.1f} frames/s, "
+            f"per core: {count['frame'] / busy:.1f} frames/s"
+        )
+
     return count
 
 
@@ -154,32 +724,115 @@ def main(args):
     sample video frames and change resolution for benchmarking
     - sample: 1 fps
     - resolution: 360p (for RGB. no change for WB)
+    - each video is decoded once for all resolutions
 
     """
 
-    sample_frames(
-        args.dirpath_input,
-        args.dirpath_output / "frames",
-        args.max_parallel_jobs,
-    )
-
-    change_frame_resolution(
-        args.dirpath_output / "frames",
-        args.dirpath_output / "frames",
-        args.max_parallel_jobs,
-    )
+    if args.only_index:
+        # frames already exist
+        dirpath_frames = args.dirpath_output / "frames"
+        recording_ids = sorted(
+            set(x.name for x in dirpath_frames.glob("*p/*_*") if x.is_dir())
+        )
+        build_frame_index(recording_ids, dirpath_frames, args.max_parallel_jobs)
+    elif args.only_resize:
+        # 2160p frames already exist
+        change_frame_resolution(
+            args.dirpath_output / "frames",
+            args.dirpath_output / "frames",
+            args.max_parallel_jobs,
+        )
+        build_frame_index(
+            sorted(x.name for x in (args.dirpath_output / "frames/2160p").glob("*_*")),
+            args.dirpath_output / "frames",
+            args.max_parallel_jobs,
+        )
+    else:
+        recording_id2frame_ids = None
+        if args.filepath_annotation:
+            # targeted extraction
+            recording_id2frame_ids = get_target_frame_ids(
+                args.filepath_annotation, args.max_frames
+            )
+        sample_frames(
+            args.dirpath_input,
+            args.dirpath_output / "frames",
+            args.max_parallel_jobs,
+            args.hwaccel,
+            args.threads_per_job,
+            recording_id2frame_ids,
+            args.force,
+            args.only_failed,
+            args.max_retries,
+            args.backoff,
+        )
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Preprocess videos")
     parser.add_argument("--dirpath_input", type=Path, help="dirpath to input")
     parser.add_argument(
-        "--filepath_annotation", type=Path, help="filepath to annotation"
+        "--filepath_annotation",
+        type=Path,
+        help="filepath to examples, if given, extract only frames used by them",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_frames",
+        type=int,
+        nargs="+",
+        help="max frames settings to extract frames for (w/ --filepath_annotation)",
+        default=[20],
     )
     parser.add_argument("--dirpath_output", type=Path, help="dirpath_output")
     parser.add_argument(
         "--max_parallel_jobs", type=int, help="max #parallel jobs", default=4
     )
+    parser.add_argument(
+        "--hwaccel",
+        type=str,
+        choices=["auto", "none"] + HWACCELS,
+        help="decoder (auto: probe cuda -> vaapi -> none)",
+        default="auto",
+    )
+    parser.add_argument(
+        "--threads_per_job",
+        type=int,
+        help="#threads per ffmpeg job (default: #cores / max_parallel_jobs for sw)",
+        default=None,
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="ignore the manifest and process all recordings",
+    )
+    parser.add_argument(
+        "--only_failed",
+        action="store_true",
+        help="only re-run recordings that failed in the previous run",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        help="max #retries of a failed ffmpeg command (the last one on cpu)",
+        default=2,
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        help="initial wait (second) before a retry, doubled every retry",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--only_index",
+        action="store_true",
+        help="only build frame index (for adaptive sampling) of existing frames",
+    )
+    parser.add_argument(
+        "--only_resize",
+        action="store_true",
+        help="only create other resolutions from existing 2160p frames",
+    )
     parser.add_argument("--dirpath_log", type=Path, help="dirpath for log")
     args = parser.parse_args()
 
@@ -0,0 +1,277 @@
+"""
+Typed examples, predictions, & evaluations
+
+* slotted dataclasses: no per-object dict, i.e., less memory & faster access
+* steps & errors are frozen, so shared (not copied) among examples
+  of the same recording
+* repeated strings, e.g., step descriptions & activity names, are interned
+* encode_examples() gives back the same dict layout (key order) as the input
+* predictions/evaluations can be kept apart, keyed by question id, and joined
+  w/ examples only when encoded, i.e., examples are never copied
+* unknown keys are kept in extra, & fields missing in the input (e.g., in
+  outputs of older versions) are None and not written back
+
+"""
+
+from dataclasses import dataclass, field
+import sys
+from typing import Any, Optional
+
+
+@dataclass(frozen=True, slots=True)
+class Error:
+    tag: str
+    description: str
+
+
+@dataclass(frozen=True, slots=True)
+class Step:
+    step_id: int
+    description: str
+    errors: Optional[tuple[Error, ...]] = None
+
+
+@dataclass(slots=True, kw_only=True)
+class Prediction:
+    prompt: str
+    frame_ids: list[str]
+    rate_inverse: int
+    sampling: Optional[str] = None
+    num_dropped_frames: Optional[int] = None
+    dirpath_images: str
+    model_id: str
+    response: Any
+    extra: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(slots=True, kw_only=True)
+class Evaluation:
+    prompt: str
+    model_id: str
+    template_type: str
+    response: Any
+    judge: Optional[str] = None
+    rationale: Optional[str] = None
+    extra: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(slots=True, kw_only=True)
+class Example:
+    """
+    one question on a recording
+    * extra: the others as is, e.g., question, answers, generation, in order
+    * only question_id, recording_id, & activity_name are required
+
+    """
+
+    recording_id: str
+    example_id: Optional[str] = None
+    end_time: Optional[str] = None
+    activity_name: str
+    previous_steps: Optional[tuple[Step, ...]] = None
+    current_step: Optional[Step] = None
+    type: Optional[str] = None
+    next_steps: Optional[tuple[Step, ...]] = None
+    missing_steps: Optional[tuple[Step, ...]] = None
+    error_description: Optional[str] = None
+    question_id: str
+    is_noisy: Optional[bool] = None
+    extra: dict[str, Any] = field(default_factory=dict)
+    prediction: Optional[Prediction] = None
+    evaluation: Optional[Evaluation] = None
+
+    @property
+    def question(self) -> str:
+        return self.extra["question"]
+
+    @property
+    def answers(self) -> list[str]:
+        return self.extra["answers"]
+
+    @property
+    def steps(self) -> tuple[Step, ...]:
+        """previous steps & the current step, if any"""
+        steps = self.previous_steps or ()
+        if self.current_step is not None:
+            steps += (self.current_step,)
+        return steps
+
+
+EXAMPLE_FIELDS = [
+    "recording_id",
+    "example_id",
+    "end_time",
+    "activity_name",
+    "previous_steps",
+    "current_step",
+    "type",
+    "next_steps",
+    "missing_steps",
+    "error_description",
+    "question_id",
+    "is_noisy",
+]
+STEP_FIELDS = ["previous_steps", "next_steps", "missing_steps"]
+PREDICTION_FIELDS = [
+    "prompt",
+    "frame_ids",
+    "rate_inverse",
+    "sampling",
+    "num_dropped_frames",
+    "dirpath_images",
+    "model_id",
+    "response",
+]
+EVALUATION_FIELDS = [
+    "prompt",
+    "model_id",
+    "template_type",
+    "response",
+    "judge",
+    "rationale",
+]
+# not written if None, e.g., in outputs of older versions
+OPTIONAL_FIELDS = [
+    "example_id",
+    "end_time",
+    "previous_steps",
+    "current_step",
+    "type",
+    "next_steps",
+    "missing_steps",
+    "error_description",
+    "is_noisy",
+    "sampling",
+    "num_dropped_frames",
+    "judge",
+    "rationale",
+]
+
+
+def decode_step(raw: dict, cache: dict) -> Step:
+    """
+    return a step, shared if the same step is already decoded
+
+    """
+    errors = None
+    if "errors" in raw:
+        errors = tuple(
+            Error(tag=sys.intern(x["tag"]), description=sys.intern(x["description"]))
+            for x in raw["errors"]
+        )
+    key = (raw["step_id"], raw["description"], errors)
+    if key not in cache:
+        cache[key] = Step(
+            step_id=raw["step_id"],
+            description=sys.intern(raw["description"]),
+            errors=errors,
+        )
+    return cache[key]
+
+
+def decode_result(cls, raw: dict, names: list[str]):
+    """
+    return a prediction/evaluation, w/ unknown keys in extra
+
+    """
+    kwargs = {"extra": {}}
+    for key, value in raw.items():
+        if key in names:
+            kwargs[key] = value
+        else:
+            kwargs["extra"][key] = value
+    return cls(**kwargs)
+
+
+def decode_examples(raws: list[dict]) -> list[Example]:
+    """
+    convert examples loaded from JSON into typed ones
+
+    """
+    cache = {}
+    examples = []
+    for raw in raws:
+        kwargs = {"extra": {}}
+        for key, value in raw.items():
+            if key in STEP_FIELDS:
+                kwargs[key] = tuple(decode_step(x, cache) for x in value)
+            elif key == "current_step":
+                kwargs[key] = decode_step(value, cache)
+            elif key in ["activity_name", "type"]:
+                kwargs[key] = sys.intern(value)
+            elif key in EXAMPLE_FIELDS:
+                kwargs[key] = value
+            elif key == "prediction":
+                kwargs[key] = decode_result(Prediction, value, PREDICTION_FIELDS)
+            elif key == "evaluation":
+                kwargs[key] = decode_result(Evaluation, value, EVALUATION_FIELDS)
+            else:
+                kwargs["extra"][key] = value
+        examples.append(Example(**kwargs))
+
+    return examples
+
+
+def encode_step(step: Step, cache: dict) -> dict:
+    """
+    return a step as dict, shared if the same step is already encoded
+
+    """
+    if step not in cache:
+        output = {"step_id": step.step_id, "description": step.description}
+        if step.errors is not None:
+            output["errors"] = [
+                {"tag": x.tag, "description": x.description} for x in step.errors
+            ]
+        cache[step] = output
+    return cache[step]
+
+
+def encode_fields(obj, names: list[str]) -> dict:
+    output = {}
+    for name in names:
+        value = getattr(obj, name)
+        if value is None and name in OPTIONAL_FIELDS:
+            continue
+        output[name] = value
+    return output
+
+
+def encode_examples(
+    examples: list[Example],
+    predictions: Optional[dict[str, Prediction]] = None,
+    evaluations: Optional[dict[str, Evaluation]] = None,
+) -> list[dict]:
+    """
+    convert typed examples into dicts to be saved as JSON
+    * predictions/evaluations: question id -> result, overlaid on examples
+
+    """
+    cache = {}
+    outputs = []
+    for example in examples:
+        prediction = example.prediction
+        if predictions and example.question_id in predictions:
+            prediction = predictions[example.question_id]
+        evaluation = example.evaluation
+        if evaluations and example.question_id in evaluations:
+            evaluation = evaluations[example.question_id]
+
+        output = encode_fields(example, EXAMPLE_FIELDS)
+        for name in STEP_FIELDS:
+            if name in output:
+                output[name] = [encode_step(x, cache) for x in output[name]]
+        if "current_step" in output:
+            output["current_step"] = encode_step(example.current_step, cache)
+        output |= example.extra
+        if prediction is not None:
+            output["prediction"] = (
+                encode_fields(prediction, PREDICTION_FIELDS) | prediction.extra
+            )
+        if evaluation is not None:
+            output["evaluation"] = (
+                encode_fields(evaluation, EVALUATION_FIELDS) | evaluation.extra
+            )
+        outputs.append(output)
+
+    return outputs
@@ -0,0 +1,216 @@
+"""
+Columnar tables (Arrow/Parquet) of examples, predictions, & evaluations
+
+* examples: one row per question id
+* predictions/evaluations: one row per (run, question id), where run is
+  the name of the file they are from, e.g., gpt-4o-2024-08-06_20_all_v1
+* steps are nested columns, list<struct<step_id, description, errors>>
+* the other fields of examples (e.g., generation), & unknown keys of
+  predictions/evaluations, are kept as a JSON string
+
+note:
+* back to JSON, the key order of the other fields may differ from the input
+
+"""
+
+from pathlib import Path
+import sys
+from typing import Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from schema import (
+    Evaluation,
+    Example,
+    Prediction,
+    EXAMPLE_FIELDS,
+    STEP_FIELDS,
+    OPTIONAL_FIELDS,
+    EVALUATION_FIELDS,
+    PREDICTION_FIELDS,
+    decode_examples,
+    encode_examples,
+)
+
+# shared JSON codec in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import dumps_json, loads_json  # noqa: E402
+
+ERROR_TYPE = pa.struct([("tag", pa.string()), ("description", pa.string())])
+STEP_TYPE = pa.struct(
+    [
+        ("step_id", pa.int64()),
+        ("description", pa.string()),
+        ("errors", pa.list_(ERROR_TYPE)),
+    ]
+)
+EXAMPLE_SCHEMA = pa.schema(
+    [
+        ("question_id", pa.string()),
+        ("recording_id", pa.string()),
+        ("example_id", pa.string()),
+        ("end_time", pa.string()),
+        ("activity_name", pa.string()),
+        ("type", pa.string()),
+        ("is_noisy", pa.bool_()),
+        ("previous_steps", pa.list_(STEP_TYPE)),
+        ("current_step", STEP_TYPE),
+        ("next_steps", pa.list_(STEP_TYPE)),
+        ("missing_steps", pa.list_(STEP_TYPE)),
+        ("error_description", pa.string()),
+        ("question", pa.string()),
+        ("answers", pa.list_(pa.string())),
+        ("extra", pa.string()),
+    ]
+)
+PREDICTION_SCHEMA = pa.schema(
+    [
+        ("run", pa.string()),
+        ("question_id", pa.string()),
+        ("model_id", pa.string()),
+        ("num_frames", pa.int64()),
+        ("frame_ids", pa.list_(pa.string())),
+        ("rate_inverse", pa.int64()),
+        ("sampling", pa.string()),
+        ("num_dropped_frames", pa.int64()),
+        ("dirpath_images", pa.string()),
+        ("prompt", pa.string()),
+        ("response", pa.string()),
+        ("extra", pa.string()),
+    ]
+)
+EVALUATION_SCHEMA = pa.schema(
+    [
+        ("run", pa.string()),
+        ("question_id", pa.string()),
+        ("model_id", pa.string()),
+        ("template_type", pa.string()),
+        ("judge", pa.string()),
+        ("rationale", pa.string()),
+        ("prompt", pa.string()),
+        ("response", pa.string()),
+        ("extra", pa.string()),
+    ]
+)
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def to_tables(run2examples: dict[str, list[Example]]) -> dict[str, pa.Table]:
+    """
+    flatten examples (w/ predictions & evaluations) of each run into tables
+    * examples in multiple runs are added once, the first one is used
+
+    """
+    example_rows, prediction_rows, evaluation_rows = [], [], []
+    question_ids = set()
+    for run, examples in run2examples.items():
+        for example, output in zip(examples, encode_examples(examples)):
+            if example.question_id not in question_ids:
+                question_ids.add(example.question_id)
+                row = {name: output.get(name) for name in EXAMPLE_SCHEMA.names}
+                # question & answers have their own columns
+                extra = {
+                    k: v
+                    for k, v in example.extra.items()
+                    if k not in ["question", "answers"]
+                }
+                row["extra"] = dumps_json(extra).decode("utf-8")
+                example_rows.append(row)
+            if "prediction" in output:
+                prediction_rows.append(
+                    output["prediction"]
+                    | {
+                        "run": run,
+                        "question_id": example.question_id,
+                        "num_frames": len(output["prediction"]["frame_ids"]),
+                        "extra": dumps_json(example.prediction.extra).decode("utf-8"),
+                    }
+                )
+            if "evaluation" in output:
+                evaluation_rows.append(
+                    output["evaluation"]
+                    | {
+                        "run": run,
+                        "question_id": example.question_id,
+                        "extra": dumps_json(example.evaluation.extra).decode("utf-8"),
+                    }
+                )
+
+    return {
+        "examples": pa.Table.from_pylist(example_rows, schema=EXAMPLE_SCHEMA),
+        "predictions": pa.Table.from_pylist(prediction_rows, schema=PREDICTION_SCHEMA),
+        "evaluations": pa.Table.from_pylist(evaluation_rows, schema=EVALUATION_SCHEMA),
+    }
+
+
+def save_tables(tables: dict[str, pa.Table], dirpath: Path, format: str) -> None:
+    for name, table in tables.items():
+        filepath = dirpath / f"{name}{FORMATS[format]}"
+        match format:
+            case "parquet":
+                pq.write_table(table, filepath)
+            case "arrow":
+                feather.write_feather(table, filepath)
+
+
+def load_table(dirpath: Path, name: str, format: str, columns=None) -> pa.Table:
+    """
+    load a table, only the columns if given
+
+    """
+    filepath = dirpath / f"{name}{FORMATS[format]}"
+    match format:
+        case "parquet":
+            return pq.read_table(filepath, columns=columns)
+        case "arrow":
+            return feather.read_table(filepath, columns=columns)
+
+
+def from_step_row(row: dict) -> dict:
+    if row["errors"] is None:
+        return {"step_id": row["step_id"], "description": row["description"]}
+    return row
+
+
+def from_tables(
+    tables: dict[str, pa.Table], run: Optional[str] = None
+) -> tuple[list[Example], dict[str, Prediction], dict[str, Evaluation]]:
+    """
+    return examples, & predictions/evaluations of the run keyed by question id,
+    which are joined by encode_examples() when saved as JSON
+
+    """
+    raws = []
+    for row in tables["examples"].to_pylist():
+        raw = {}
+        for name in EXAMPLE_FIELDS:
+            value = row[name]
+            if value is None and name in OPTIONAL_FIELDS:
+                continue
+            if name in STEP_FIELDS:
+                value = [from_step_row(x) for x in value]
+            elif name == "current_step":
+                value = from_step_row(value)
+            raw[name] = value
+        raw |= loads_json(row["extra"])
+        for name in ["question", "answers"]:
+            if row[name] is not None:
+                raw[name] = row[name]
+        raws.append(raw)
+    examples = decode_examples(raws)
+
+    question_id2prediction, question_id2evaluation = {}, {}
+    if run is not None:
+        for row in tables["predictions"].filter(pc.field("run") == run).to_pylist():
+            question_id2prediction[row["question_id"]] = Prediction(
+                **{k: v for k, v in row.items() if k in PREDICTION_FIELDS},
+                extra=loads_json(row["extra"]),
+            )
+        for row in tables["evaluations"].filter(pc.field("run") == run).to_pylist():
+            question_id2evaluation[row["question_id"]] = Evaluation(
+                **{k: v for k, v in row.items() if k in EVALUATION_FIELDS},
+                extra=loads_json(row["extra"]),
+            )
+
+    return examples, question_id2prediction, question_id2evaluation
@@ -8,6 +8,7 @@ import base64
 from collections import defaultdict
 from datetime import datetime
 import google as genai
+import io
 import json
 
 # from litellm import completion
@@ -16,8 +17,23 @@ import os
 from openai import OpenAI
 from pathlib import Path
 import pydot
-import re
+import sys
 from typing import Any, Optional
+from schema import Example, Step
+
+# shared modules in src/, the JSON codec is also re-exported for scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import dumps_json, loads_json, load_json, save_json  # noqa: E402, F401
+from utils_frame import (  # noqa: E402
+    PackedFrame,
+    open_archive,
+    extract_index,
+    convert_time,
+    sample_frame_ids,
+    load_frame_index,
+    dedup_frames,
+    sample_frame_ids_adaptive,
+)
 
 
 PRICE = {
@@ -76,6 +92,24 @@ Answer the following question by the user in one sentence, based on the given in
 # idea: feed recipe as an image instead of text
 
 
+def get_feedback_schema(template_type: str) -> dict:
+    """
+    JSON schema for structured-output evaluation: rationale + judge
+    note: judge is a string to match the one parsed from "[Judge]"
+
+    """
+    options = ["0", "1"] if "binary" in template_type else ["0", "1", "2"]
+    return {
+        "type": "object",
+        "properties": {
+            "rationale": {"type": "string"},
+            "judge": {"type": "string", "enum": options},
+        },
+        "required": ["rationale", "judge"],
+        "additionalProperties": False,
+    }
+
+
 def get_date(granularity: Optional[str] = "min") -> str:
     """
     get date
@@ -98,8 +132,7 @@ def load_recipe(filepath_graph: Path):
 
     """
 
-    with open(filepath_graph, "r") as f:
-        raw_graphs = json.load(f)
+    raw_graphs = load_json(filepath_graph)
 
     activity_name2recipe = {}
     for activity_id, graph in raw_graphs.items():
@@ -123,60 +156,104 @@ def load_recipe(filepath_graph: Path):
     return activity_name2recipe
 
 
-def extract_index(filepath):
-    return int(re.search(r"\d+", filepath.stem).group())
-
-
-def encode_image(filepath: Path) -> Any:
+def encode_image(filepath: Path | PackedFrame) -> Any:
+    if isinstance(filepath, PackedFrame):
+        return filepath.archive.encode(filepath.frame_id)
     with open(filepath, "rb") as f:
         return base64.b64encode(f.read()).decode("utf-8")
 
 
-def convert_time(time: str) -> int:
-    hh, mm, ss = time.split(":")
-    return int(mm) * 60 + int(ss)
+def upload_image(filepath: Path | PackedFrame) -> Any:
+    """upload an image to gemini"""
+    if isinstance(filepath, PackedFrame):
+        return genai.upload_file(
+            io.BytesIO(filepath.archive.get(filepath.frame_id)),
+            mime_type="image/png",
+        )
+    return genai.upload_file(filepath)
 
 
 def load_frame(
-    example: Any, dirpath: Path, max_frames: int
-) -> tuple[list[str], list[str], float]:
+    example: Example,
+    dirpath: Path,
+    max_frames: int,
+    sampling: str = "uniform",
+    dedup_threshold: Optional[int] = None,
+) -> tuple[list[str], list[str], int, int]:
     """
     load & sample frames
+    * sampling: uniform (stride) or adaptive (more frames around scene changes)
+    * dedup_threshold: if given, collapse near-duplicate frames before sampling
+    * return: frame paths, frame ids, rate_inverse, & #dropped duplicates
+
+    note:
+    * #frames is the last frame id up to end_time, so that sampling is the same
+      w/ all frames extracted and w/ only targeted frames extracted
+    * frames are read from <recording_id>.pack if it exists (see pack_frame.py)
+    * adaptive sampling & dedup need <recording_id>.index.npz, otherwise skipped
+    * rate_inverse of adaptive sampling is the average, #frames / #sampled
+      (rounded up), an integer as w/ uniform sampling
 
     """
 
     logging.info("load & sample frames")
 
-    dirpath_frame = dirpath / example["recording_id"]
-    end_time_second = convert_time(example["end_time"])
-
-    filepaths_frame = []
-    for filepath in dirpath_frame.glob("*.png"):
-        if int(filepath.stem) <= end_time_second:
-            filepaths_frame.append(filepath)
+    dirpath_frame = dirpath / example.recording_id
+    filepath_archive = dirpath / f"{example.recording_id}.pack"
+    end_time_second = convert_time(example.end_time)
 
-    num_frames = len(filepaths_frame)
-    # e.g., 700 frames, max 250 => rate: 1 frame per every 3 frames
-    if num_frames > max_frames:
-        if num_frames % max_frames == 0:
-            rate_inverse = num_frames // max_frames
+    archive = None
+    if filepath_archive.exists():
+        archive = open_archive(filepath_archive)
+        available_ids = set(archive.frame_ids())
+    else:
+        available_ids = set(extract_index(x) for x in dirpath_frame.glob("*.png"))
+
+    num_frames = max([x for x in available_ids if x <= end_time_second], default=0)
+
+    frame_index = None
+    if sampling == "adaptive" or dedup_threshold is not None:
+        frame_index = load_frame_index(dirpath / f"{example.recording_id}.index.npz")
+        if frame_index is None:
+            logging.warning(f"Frame index not found, use uniform: {dirpath_frame}")
+
+    num_dropped = 0
+    if frame_index is not None:
+        mask = frame_index["frame_ids"] <= num_frames
+        candidate_ids = frame_index["frame_ids"][mask].tolist()
+        signatures = frame_index["signatures"][mask]
+
+        if dedup_threshold is not None:
+            if "phashes" in frame_index:
+                indices = dedup_frames(frame_index["phashes"][mask], dedup_threshold)
+                num_dropped = len(candidate_ids) - len(indices)
+                candidate_ids = [candidate_ids[x] for x in indices]
+                signatures = signatures[indices]
+                logging.info(f"#dropped duplicates: {num_dropped}")
+            else:
+                logging.warning(f"phashes not found, skip dedup: {dirpath_frame}")
+
+        if sampling == "adaptive":
+            frame_ids = sample_frame_ids_adaptive(candidate_ids, signatures, max_frames)
+            rate_inverse = -(-len(candidate_ids) // max(len(frame_ids), 1))
         else:
-            rate_inverse = (num_frames // max_frames) + 1
+            positions, rate_inverse = sample_frame_ids(len(candidate_ids), max_frames)
+            frame_ids = [candidate_ids[x - 1] for x in positions]
     else:
-        rate_inverse = 1
-    filepaths_frame_sorted = sorted(filepaths_frame, key=extract_index)
+        frame_ids, rate_inverse = sample_frame_ids(num_frames, max_frames)
 
     sampled_frame_paths, sampled_frame_ids = [], []
-    # note: "reversed" to make sure the last frame is included in the input
-    for idx, filepath_frame in enumerate(reversed(filepaths_frame_sorted)):
-        # change sample rate
-        if idx % rate_inverse == 0:
-            sampled_frame_paths.insert(0, filepath_frame)
-            sampled_frame_ids.insert(0, filepath_frame.stem)
-
-    assert len(sampled_frame_paths) <= max_frames
+    for frame_id in frame_ids:
+        if frame_id not in available_ids:
+            logging.warning(f"Frame not found: {dirpath_frame / f'{frame_id}.png'}")
+            continue
+        if archive:
+            sampled_frame_paths.append(PackedFrame(archive, frame_id))
+        else:
+            sampled_frame_paths.append(dirpath_frame / f"{frame_id}.png")
+        sampled_frame_ids.append(str(frame_id))
 
-    return sampled_frame_paths, sampled_frame_ids, rate_inverse
+    return sampled_frame_paths, sampled_frame_ids, rate_inverse, num_dropped
 
 
 def get_text_content(
@@ -248,7 +325,7 @@ def get_image_content(
         ]
     elif "gemini" in model_id:
         genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-        content = [genai.upload_file(image_path) for image_path in image_paths]
+        content = [upload_image(image_path) for image_path in image_paths]
     else:
         logging.error(f"Undefined {model_id=}")
         content = []
@@ -256,13 +333,13 @@ def get_image_content(
     return content
 
 
-def format_steps(steps: list, w_error: bool = False) -> str:
+def format_steps(steps: list[Step], w_error: bool = False) -> str:
     output = ""
     for step in steps:
-        output += f"- {step['description']}\n"
-        if w_error and "errors" in step:
-            for error in step["errors"]:
-                output += f"    - [{error['tag']}] {error['description']}\n"
+        output += f"- {step.description}\n"
+        if w_error and step.errors is not None:
+            for error in step.errors:
+                output += f"    - [{error.tag}] {error.description}\n"
 
     return output.strip()
 
@@ -272,7 +349,7 @@ def get_text_content_evaluation(
     template_type: str,
     components: dict,
     name2recipe: dict,
-    example: dict,
+    example: Example,
 ) -> tuple[list, str]:
     """
 
@@ -291,19 +368,19 @@ def get_text_content_evaluation(
         template += f"\n{components['note']['step']}"
     template += f"\n{components['task']}"
 
-    steps = example["previous_steps"] + [example["current_step"]]
+    steps = example.steps
 
-    question = f"- {example['question']}"
-    gold_answers = "\n".join([f"- {answer}" for answer in example["answers"]]).strip()
-    if "human_answer" in example:
-        predicted_answer = f"- {example['human_answer']}"
+    question = f"- {example.question}"
+    gold_answers = "\n".join([f"- {answer}" for answer in example.answers]).strip()
+    if "human_answer" in example.extra:
+        predicted_answer = f"- {example.extra['human_answer']}"
     else:
-        predicted_answer = f"- {example['prediction']['response']}"
+        predicted_answer = f"- {example.prediction.response}"
 
     prompt = (
-        template.replace("{activity_name}", example["activity_name"])
+        template.replace("{activity_name}", example.activity_name)
         .replace("{step_information}", format_steps(steps=steps, w_error=True))
-        .replace("{recipe}", name2recipe[example["activity_name"]]["dot"])
+        .replace("{recipe}", name2recipe[example.activity_name]["dot"])
         .replace("{question}", question)
         .replace("{gold_answer}", gold_answers)
         .replace("{predicted_answer}", predicted_answer)
@@ -346,11 +423,16 @@ def call_api(
     content: list,
     temperature: float,
     max_tokens: int,
+    response_schema: Optional[dict] = None,
 ) -> tuple[str, tuple[int, int]]:
     """
     call API via LiteLLM
     except Gemini
 
+    note:
+    * w/ response_schema, the output is a JSON string following the schema
+        * gpt: response_format, claude: forced tool use, gemini: response_schema
+
     """
 
     output = None
@@ -358,33 +440,64 @@ def call_api(
     try:
         if "gpt" in model_id:
             client = OpenAI()
+            kwargs = {}
+            if response_schema:
+                kwargs["response_format"] = {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "output",
+                        "schema": response_schema,
+                        "strict": True,
+                    },
+                }
             response = client.chat.completions.create(
                 model=model_id,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 messages=[{"role": "user", "content": content}],
+                **kwargs,
             )
             output = response.choices[0].message.content
             tokens["input"] = response.usage.prompt_tokens
             tokens["output"] = response.usage.completion_tokens
         elif "claude" in model_id:
             client = anthropic.Anthropic()
+            kwargs = {}
+            if response_schema:
+                kwargs["tools"] = [{"name": "output", "input_schema": response_schema}]
+                kwargs["tool_choice"] = {"type": "tool", "name": "output"}
             response = client.messages.create(
                 model=model_id,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 messages=[{"role": "user", "content": content}],
+                **kwargs,
             )
-            output = response.content[0].text
+            if response_schema:
+                output = json.dumps(
+                    [x.input for x in response.content if x.type == "tool_use"][0]
+                )
+            else:
+                output = response.content[0].text
             tokens["input"] = response.usage.input_tokens
             tokens["output"] = response.usage.output_tokens
         elif "gemini" in model_id:
             model = genai.GenerativeModel(model_name=str(Path(model_id).name))
+            kwargs = {}
+            if response_schema:
+                # gemini does not accept additionalProperties
+                kwargs["response_mime_type"] = "application/json"
+                kwargs["response_schema"] = {
+                    k: v
+                    for k, v in response_schema.items()
+                    if k != "additionalProperties"
+                }
             response = model.generate_content(
                 content,
                 generation_config=genai.GenerationConfig(
                     max_output_tokens=max_tokens,
                     temperature=temperature,
+                    **kwargs,
                 ),
             )
             output = response.text
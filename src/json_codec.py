@@ -0,0 +1,67 @@
+"""
+JSON codec shared by all stages
+
+* orjson or msgspec if installed, stdlib json otherwise
+* JSON_BACKEND can be switched, e.g., to compare backends
+* compact output by default, pretty (indented) if requested
+* scripts in src/<stage>/ import it after adding src/ to sys.path
+
+"""
+
+import json
+from pathlib import Path
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# installed ones, in order of preference
+JSON_BACKENDS = [
+    name for name, module in [("orjson", orjson), ("msgspec", msgspec)] if module
+] + ["json"]
+JSON_BACKEND = JSON_BACKENDS[0]
+
+
+def dumps_json(data: Any, pretty: bool = False) -> bytes:
+    """
+    encode data into JSON bytes, the same w/ any backend
+    * compact: w/ the backend, non-ASCII characters as is (UTF-8)
+    * pretty: always w/ stdlib json & indent=4, as files written before, since
+      orjson supports indent=2 only
+
+    """
+    if pretty:
+        return json.dumps(data, indent=4, ensure_ascii=False).encode("utf-8")
+    match JSON_BACKEND:
+        case "orjson":
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        case "msgspec":
+            return msgspec.json.encode(data)
+        case _:
+            return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode(
+                "utf-8"
+            )
+
+
+def loads_json(raw: bytes | str) -> Any:
+    match JSON_BACKEND:
+        case "orjson":
+            return orjson.loads(raw)
+        case "msgspec":
+            return msgspec.json.decode(raw)
+        case _:
+            return json.loads(raw)
+
+
+def load_json(filepath: Path) -> Any:
+    return loads_json(Path(filepath).read_bytes())
+
+
+def save_json(data: Any, filepath: Path, pretty: bool = False) -> None:
+    Path(filepath).write_bytes(dumps_json(data, pretty=pretty) + b"\n")
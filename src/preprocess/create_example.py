@@ -6,32 +6,124 @@ Create examples from CaptainCook4D
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
-import json
 from collections import defaultdict
-from copy import deepcopy
+import multiprocessing
 from utils_create_example import (
+    RecordingState,
     get_activity_name2recipe,
-    get_next_steps,
-    get_missing_steps,
     check_if_this_is_missing_step,
     check_end_time,
-    check_overlap,
+    StepIntervals,
     format2hhmmss,
-    get_end_time,
     sanity_check_order_error,
-    check_errors,
-    get_target_description,
-    check_if_target_error_exists,
+    index_errors,
     get_video_metadata,
+    QUESTION_RULES,
 )
+from utils_io import iter_examples, save_examples, batched
+
+
+def create_examples(example: dict, recipe: dict) -> dict:
+    """
+    create examples (question id -> example) of one recording
+    * recipe: steps & index (RecipeIndex), w/o networkx graph, to be sent to workers
+
+    """
+    targets = {}
+    # previous steps & next/missing steps, updated step by step
+    state = RecordingState(recipe["index"])
+    # latest end time & overlap w/ following steps, in constant time
+    intervals = StepIntervals(example["step_annotations"])
+    for idx, step in enumerate(example["step_annotations"]):
+        # note: better to use this idx for question id? <= i think step_id is enough
+
+        if check_if_this_is_missing_step(step):
+            continue
+
+        # skip examples if the input video is too short
+        if step["end_time"] < 5:
+            if step["step_id"] != -1:
+                logging.warning(f"If exists, this should be added as prev: {step}")
+            continue
+
+        current_step = {
+            "step_id": step["step_id"],
+            "description": (
+                step["modified_description"]
+                if "modified_description" in step
+                else step["description"]
+            ),
+        }
+        if "errors" in step:
+            # shared (not copied) w/ the annotation, neither is modified
+            current_step["errors"] = step["errors"]
+
+        end_time = intervals.get_end_time(idx)
+        state_w_step = state.add(step["step_id"])
+
+        # skip if the current step overlaps with any of following steps
+        # to avoid any errornous cases after adding it to prev steps
+        if intervals.check_overlap(idx=idx, current_end_time=end_time):
+            is_overlap = True
+        else:
+            is_overlap = False
+
+        # create example base
+        example_id = f"{example['recording_id']}_{current_step['step_id']}"
+        target = {
+            "recording_id": example["recording_id"],
+            "example_id": example_id,
+            "end_time": format2hhmmss(end_time),
+            "activity_name": example["activity_name"],
+            # shared (not copied) among examples
+            "previous_steps": state.previous_steps,
+            "current_step": current_step,
+        }
+
+        # == create examples ==
+
+        # sanity check
+        sanity_check_order_error(
+            example["recording_id"],
+            step,
+            state,
+            state_w_step,
+        )
+
+        # errors of this step are indexed once, shared by all question types
+        tag2error = index_errors(step)
+        for question_type, rule in QUESTION_RULES.items():
+            question_id = f"{example_id}_{question_type}"
+            # duplicates: one step is performed in multiple timings, e.g.,
+            # A -> B -> A, not an annotation error, so just skip these cases.
+            if (
+                (question_id in targets)  # avoid duplicates
+                or is_overlap  # avoid edge cases
+                or (not rule.is_eligible(step, tag2error))
+            ):
+                continue
+            targets[question_id] = (
+                target
+                | {"type": question_type}
+                | rule.build(recipe, state_w_step, tag2error)
+                | {
+                    "question_id": question_id,
+                    "is_noisy": state.check_errors(rule.exclude_types),
+                }
+            )
+
+        # add this step to history
+        if step["step_id"] > 0:  # skip for start step
+            state = state_w_step.append(current_step)
+
+    return targets
 
 
 def main(args):
     activity_name2recipe = get_activity_name2recipe(args.dirpath_graph)
 
-    # load annotation
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    # load annotation, one recording at a time if JSONL
+    examples = iter_examples(args.filepath_input)
 
     # # load mapping
     # with open(args.filepath_verbs, "r") as f:
@@ -40,7 +132,7 @@ def main(args):
     w_4k_video = get_video_metadata(args.filepath_metadata_video)
 
     """
-    [target]
+    [target] (see QUESTION_RULES)
     - next step
     - order error
     - missing step
@@ -50,276 +142,47 @@ def main(args):
     - measurement error
     - temperature error
     """
-    targets = {}
-    for example in examples:
-        # skip if 4k video is not available
-        if not w_4k_video[example["recording_id"]]:
-            continue
 
-        _activity_name = example["activity_name"].lower().replace(" ", "")
-        previous_steps = []
-        for idx, step in enumerate(example["step_annotations"]):
-            # note: better to use this idx for question id? <= i think step_id is enough
-
-            if check_if_this_is_missing_step(step):
-                continue
-
-            # skip examples if the input video is too short
-            if step["end_time"] < 5:
-                if step["step_id"] != -1:
-                    logging.warning(f"If exists, this should be added as prev: {step}")
+    def get_jobs():
+        for example in examples:
+            # skip if 4k video is not available
+            if not w_4k_video[example["recording_id"]]:
                 continue
 
-            current_step = {
-                "step_id": step["step_id"],
-                "description": (
-                    step["modified_description"]
-                    if "modified_description" in step
-                    else step["description"]
-                ),
-            }
-            if "errors" in step:
-                current_step["errors"] = deepcopy(step["errors"])
-
-            end_time = get_end_time(idx, example["step_annotations"])
-
-            # skip if the current step overlaps with any of following steps
-            # to avoid any errornous cases after adding it to prev steps
-            if check_overlap(
-                idx=idx, current_end_time=end_time, steps=example["step_annotations"]
-            ):
-                is_overlap = True
-            else:
-                is_overlap = False
-
-            # create example base
-            example_id = f"{example['recording_id']}_{current_step['step_id']}"
-            target = {
-                "recording_id": example["recording_id"],
-                "example_id": example_id,
-                "end_time": format2hhmmss(end_time),
-                "activity_name": example["activity_name"],
-                "previous_steps": deepcopy(previous_steps),
-                "current_step": current_step,
-            }
-
-            # == create examples ==
-
-            """
-            create prompt for next step questions
-            note:
-            * create even if this is the last step, then answer would be none.
-            * skip if the current step overlap with the next step duration
-            """
-            question_id = f"{example_id}_next"
-            if (question_id in targets) or is_overlap:
-                """
-                e.g., one step is performed in multiple timings, like A -> B -> A
-                this cannot be said as an annotation error, so just skip these cases.
-                """
-                pass
-                # logging.warning(f"Duplicate example found. Skip: {question_id}")
-            else:
-                next_steps = get_next_steps(
-                    activity_name2recipe[_activity_name],
-                    [x["step_id"] for x in previous_steps] + [step["step_id"]],
-                )
-                targets[question_id] = target | {
-                    "type": "next",
-                    "next_steps": next_steps,
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            """
-            create missing step questions
-            note:
-            * create even if there is no missing step, then answer would be none
-            """
-            question_id = f"{example_id}_missing"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-            ):
-                pass
-            else:
-                missing_steps = get_missing_steps(
-                    activity_name2recipe[_activity_name],
-                    [x["step_id"] for x in previous_steps] + [step["step_id"]],
-                )
-                targets[question_id] = target | {
-                    "type": "missing",
-                    "missing_steps": missing_steps,
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps, ["Missing Step"]),
-                }
-
-            """
-            create prompt for order error questions
-            only when order error description is available
-
-            think: what is answer==none questions for order error
-            """
-            # sanity check
-            sanity_check_order_error(
-                example["recording_id"],
-                step,
-                activity_name2recipe[_activity_name],
-                previous_steps,
-            )
-
-            question_id = f"{example_id}_order"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                or (not check_if_target_error_exists(step, "Order Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "order",
-                    "error_description": get_target_description(step, "Order Error"),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(
-                        previous_steps, ["Order Error", "Missing Step"]
-                    ),
-                }
-
-            """
-            create example for preparation error
-
-            """
-            question_id = f"{example_id}_preparation"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                # or (not check_if_target_verb(step, "Preparation Error", error_type2verbs))
-                # # verb-based rough selection
-                or (not check_if_target_error_exists(step, "Preparation Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "preparation",
-                    "error_description": get_target_description(
-                        step, "Preparation Error"
-                    ),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            """
-            create example for measurement error
-
-            """
-            question_id = f"{example_id}_measurement"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                # or (not check_if_target_verb(step, "Measurement Error", error_type2verbs))
-                # # verb-based rough selection
-                or (not check_if_target_error_exists(step, "Measurement Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "measurement",
-                    "error_description": get_target_description(
-                        step, "Measurement Error"
-                    ),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            """
-            create example for timing error
-
-            """
-            question_id = f"{example_id}_timing"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                # or (not check_if_target_verb(step, "Timing Error", error_type2verbs))
-                # # verb-based rough selection
-                or (not check_if_target_error_exists(step, "Timing Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "timing",
-                    "error_description": get_target_description(step, "Timing Error"),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            """
-            create example for technique error
-
-            """
-            question_id = f"{example_id}_technique"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                # or (not check_if_target_verb(step, "Technique Error", error_type2verbs))
-                # # verb-based rough selection
-                or (not check_if_target_error_exists(step, "Technique Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "technique",
-                    "error_description": get_target_description(
-                        step, "Technique Error"
-                    ),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            """
-            create example for temperature error
-
-            """
-            question_id = f"{example_id}_temperature"
-            if (
-                (step["step_id"] <= 0)  # skip for start step
-                or (question_id in targets)  # avoid duplicates
-                or is_overlap  # avoid edge cases
-                # or (not check_if_target_verb(step, "Temperature Error", error_type2verbs))
-                # # verb-based rough selection
-                or (not check_if_target_error_exists(step, "Temperature Error"))
-            ):
-                pass
-            else:
-                targets[question_id] = target | {
-                    "type": "temperature",
-                    "error_description": get_target_description(
-                        step, "Temperature Error"
-                    ),
-                    "question_id": question_id,
-                    "is_noisy": check_errors(previous_steps),
-                }
-
-            # add this step to history
-            if step["step_id"] > 0:  # skip for start step
-                previous_steps.append(deepcopy(current_step))
+            _activity_name = example["activity_name"].lower().replace(" ", "")
+            recipe = activity_name2recipe[_activity_name]
+            yield (example, {"steps": recipe["steps"], "index": recipe["index"]})
+
+    def get_results():
+        if args.num_workers > 1:
+            # each recording only depends on its annotation & recipe
+            # note: in batches, not to read the whole input ahead
+            with multiprocessing.Pool(processes=args.num_workers) as pool:
+                for jobs in batched(get_jobs(), args.num_workers * 8):
+                    yield from pool.starmap(create_examples, jobs, chunksize=8)
+        else:
+            for job in get_jobs():
+                yield create_examples(*job)
 
     count = defaultdict(int)
-    for target in targets.values():
-        count[target["type"]] += 1
 
-    logging.info(f"Total #prompt: {len(targets)} ({dict(count)})")
+    def get_targets():
+        # merge in the input order, so that the output is the same as serial
+        question_ids = set()
+        for _targets in get_results():
+            for question_id, target in _targets.items():
+                # e.g., the same recording appears twice
+                if question_id in question_ids:
+                    continue
+                question_ids.add(question_id)
+                count[target["type"]] += 1
+                check_end_time([target])
+                yield target
 
-    check_end_time(targets.values())
+    filepath_output = args.filepath_output or args.dirpath_output / "all_examples.json"
+    num_targets = save_examples(get_targets(), filepath_output, pretty=args.pretty)
 
-    with open(args.dirpath_output / "all_examples.json", "w") as f:
-        json.dump(list(targets.values()), f, indent=4)
-        f.write("\n")
+    logging.info(f"Total #prompt: {num_targets} ({dict(count)})")
 
 
 if __name__ == "__main__":
@@ -338,7 +201,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "--filepath_metadata_video", type=Path, help="filepath to video metadata"
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        help="#processes to create examples of recordings in parallel",
+        default=1,
+    )
     parser.add_argument("--dirpath_output", type=Path, help="dirpath to output data")
+    parser.add_argument(
+        "--filepath_output",
+        type=Path,
+        help="filepath to output (.json/.jsonl, - for stdout as JSONL) "
+        "(default: <dirpath_output>/all_examples.json)",
+        default=None,
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="log")
 
     args = parser.parse_args()
@@ -12,10 +12,10 @@ Create
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
-import json
 import pydot
 from tqdm import tqdm
 from datetime import datetime
+from utils_io import iter_examples, load_json
 
 
 def get_date(granularity="min") -> str:
@@ -35,8 +35,7 @@ def get_date(granularity="min") -> str:
 
 
 def load_data(filepath: Path) -> list[dict[str, str | float]]:
-    with open(filepath, "r") as f:
-        return json.load(f)
+    return load_json(filepath)
 
 
 def get_activity_name2recipe(filepath: Path):
@@ -45,8 +44,7 @@ def get_activity_name2recipe(filepath: Path):
 
     """
 
-    with open(filepath, "r") as f:
-        data = json.load(f)
+    data = load_json(filepath)
 
     name2recipe = {}
     for example in data.values():
@@ -137,8 +135,8 @@ def create_folders(dirpaths: list[Path]) -> None:
 
 
 def main(args):
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    # one example at a time if JSONL
+    examples = iter_examples(args.filepath_input)
 
     recipes = get_activity_name2recipe(args.filepath_graph)
 
@@ -3,9 +3,9 @@
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
-import json
 from collections import defaultdict
 import random
+from utils_io import load_examples, save_examples, is_jsonl
 
 
 def get_stat(examples) -> None:
@@ -268,8 +268,8 @@ def sample(
 
 
 def main(args):
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    # note: loaded at once, examples are sampled over all recordings
+    examples = load_examples(args.filepath_input)
 
     logging.info("Stats of all examples")
     get_stat(examples)
@@ -299,21 +299,35 @@ def main(args):
 
     assert len(samples) + len(remainings) == len(examples)
 
-    with open(args.dirpath_output / f"samples_{args.target_num}.json", "w") as f:
-        json.dump(samples, f, indent=4)
-        f.write("\n")
-
-    with open(args.dirpath_output / f"remainings_{args.target_num}.json", "w") as f:
-        json.dump(remainings, f, indent=4)
-        f.write("\n")
+    # remainings are in the same format as samples, next to them unless stdout
+    filepath_output = (
+        args.filepath_output or args.dirpath_output / f"samples_{args.target_num}.json"
+    )
+    suffix = ".jsonl" if is_jsonl(filepath_output) else ".json"
+    save_examples(samples, filepath_output, pretty=args.pretty)
+    save_examples(
+        remainings,
+        args.dirpath_output / f"remainings_{args.target_num}{suffix}",
+        pretty=args.pretty,
+    )
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="")
     parser.add_argument("--filepath_input", type=Path, help="filepath to input data")
     parser.add_argument("--dirpath_output", type=Path, help="dirpath to output")
+    parser.add_argument(
+        "--filepath_output",
+        type=Path,
+        help="filepath to samples (.json/.jsonl, - for stdout as JSONL) "
+        "(default: <dirpath_output>/samples_<target_num>.json)",
+        default=None,
+    )
     parser.add_argument("--target_num", type=int, default=1000)  # 10
     parser.add_argument("--seed", type=int, help="random seed", default=42)
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="log")
 
     args = parser.parse_args()
@@ -8,7 +8,6 @@ Update CaptainCook4D annotation
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
-import json
 import networkx as nx
 import pydot
 from copy import deepcopy
@@ -22,6 +21,7 @@ from utils_update_annotation import (
     adjust_step_id,
     sanity_check_adjustment,
 )
+from utils_io import load_examples, save_examples, load_json, save_json
 
 
 def get_activity_id2name(path: Path) -> dict[int, str]:
@@ -32,8 +32,7 @@ def get_activity_id2name(path: Path) -> dict[int, str]:
 
     """
 
-    with open(path, "r") as f:
-        examples = json.load(f)
+    examples = load_json(path)
 
     id2name = {}
     for _, example in examples.items():
@@ -69,8 +68,7 @@ def get_activity_id2recipe(dirpath: Path, activity_id2name):
     for filepath in dirpath.glob("*.json"):
         idx = name2id[filepath.stem]
 
-        with open(filepath, "r") as f:
-            data = json.load(f)
+        data = load_json(filepath)
 
         G = nx.DiGraph()
         G.add_edges_from(data["edges"])
@@ -107,8 +105,7 @@ def get_activity_id2min_step_id(filepath):
     return mapping from activity id to minimum step id
 
     """
-    with open(filepath, "r") as f:
-        data = json.load(f)
+    data = load_json(filepath)
     activity_id2start_index = {}
     for activity_id, ids in data.items():
         activity_id2start_index[int(activity_id)] = min(ids) - 1
@@ -138,8 +135,8 @@ def main(args):
     activity_id2recipe = get_activity_id2recipe(args.dirpath_graph, activity_id2name)
 
     # load annotation
-    with open(args.filepath_error, "r") as f:
-        examples = json.load(f)
+    # note: loaded at once, manual updates refer to examples by position
+    examples = load_examples(args.filepath_error)
 
     # udpate annotation
     examples = update_step_description(examples)
@@ -179,9 +176,11 @@ def main(args):
             new_example["step_annotations"]
         )
 
-    with open(args.dirpath_output / "original_updated.json", "w") as f:
-        json.dump(new_examples, f, indent=4)
-        f.write("\n")
+    save_examples(
+        new_examples,
+        args.filepath_output or args.dirpath_output / "original_updated.json",
+        pretty=args.pretty,
+    )
 
     # compile a list of verbs for each error to limit answer==none questions
     error2verbs = defaultdict(list)
@@ -194,9 +193,9 @@ def main(args):
     for error, verbs in error2verbs.items():
         error2verbs[error] = sorted(list(set(verbs)))
 
-    with open(args.dirpath_output / "error_type_to_verbs.json", "w") as f:
-        json.dump(error2verbs, f, indent=4)
-        f.write("\n")
+    save_json(
+        error2verbs, args.dirpath_output / "error_type_to_verbs.json", args.pretty
+    )
 
     # collect graph into one file
     logging.info("Creating recipe images")
@@ -213,9 +212,7 @@ def main(args):
         }
         recipe["graph_pydot"].write_png(dirpath_graph_images / f"{activity_id}.png")
 
-    with open(args.dirpath_output / "all_graphs.json", "w") as f:
-        json.dump(activity_id2graph, f, indent=4)
-        f.write("\n")
+    save_json(activity_id2graph, args.dirpath_output / "all_graphs.json", args.pretty)
 
 
 if __name__ == "__main__":
@@ -233,6 +230,16 @@ if __name__ == "__main__":
         "--dirpath_graph", type=Path, help="dirpath to task graph annotation"
     )
     parser.add_argument("--dirpath_output", type=Path, help="dirpath to output data")
+    parser.add_argument(
+        "--filepath_output",
+        type=Path,
+        help="filepath to updated annotation (.json/.jsonl, - for stdout as JSONL) "
+        "(default: <dirpath_output>/original_updated.json)",
+        default=None,
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="log")
 
     args = parser.parse_args()
@@ -1,8 +1,10 @@
 import logging
 from pathlib import Path
-import json
 import networkx as nx
-from copy import deepcopy
+from copy import copy
+import math
+from typing import Callable, NamedTuple, Optional
+from utils_io import load_json
 
 
 # def get_target_error(errors):
@@ -21,22 +23,154 @@ from copy import deepcopy
 #         return None
 
 
+class RecipeIndex:
+    """
+    compiled recipe graph: predecessors, successors, ancestors, & descendants
+    of each step as bitmasks, computed once per activity
+
+    note:
+    * bit i: i-th node in the graph's node order (not step id, which can be -1)
+    * step ids not in the graph are ignored in masks
+
+    """
+
+    def __init__(self, G: nx.DiGraph, steps: dict[int, str]):
+        self.nodes = list(G.nodes)
+        self.node2bit = {node: 1 << idx for idx, node in enumerate(self.nodes)}
+        self.predecessors = [self.to_mask(G.predecessors(x)) for x in self.nodes]
+        self.successors = [self.to_mask(G.successors(x)) for x in self.nodes]
+        self.ancestors = [self.to_mask(nx.ancestors(G, x)) for x in self.nodes]
+        self.descendants = [self.to_mask(nx.descendants(G, x)) for x in self.nodes]
+        self.end = self.to_mask(x for x in self.nodes if steps[x] == "END")
+
+    def to_mask(self, step_ids) -> int:
+        mask = 0
+        for step_id in step_ids:
+            mask |= self.node2bit.get(step_id, 0)
+        return mask
+
+    @staticmethod
+    def iter_bits(mask: int):
+        """positions of set bits, from the lowest"""
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def to_step_ids(self, mask: int) -> list[int]:
+        """step ids in the graph's node order"""
+        return [self.nodes[idx] for idx in self.iter_bits(mask)]
+
+    def is_next(self, idx: int, passed: int) -> bool:
+        """all predecessors are passed, & no descendant is passed"""
+        return not (self.predecessors[idx] & ~passed) and not (
+            self.descendants[idx] & passed
+        )
+
+    def is_missing(self, idx: int, passed: int) -> bool:
+        """at least one ancestor & one descendant are passed"""
+        return bool(self.ancestors[idx] & passed) and bool(
+            self.descendants[idx] & passed
+        )
+
+    def get_next_mask(self, passed: int) -> int:
+        mask = 0
+        for idx in self.iter_bits(self.get_todo_mask(passed)):
+            if self.is_next(idx, passed):
+                mask |= 1 << idx
+        return mask
+
+    def get_missing_mask(self, passed: int) -> int:
+        mask = 0
+        for idx in self.iter_bits(self.get_todo_mask(passed)):
+            if self.is_missing(idx, passed):
+                mask |= 1 << idx
+        return mask
+
+    def get_todo_mask(self, passed: int) -> int:
+        """steps not passed yet, except end"""
+        return ((1 << len(self.nodes)) - 1) & ~passed & ~self.end
+
+
+class RecordingState:
+    """
+    state of a recording while its steps are added one by one
+    * passed/next/missing: bitmasks (see RecipeIndex), updated only around
+      the added step, i.e., O(#steps connected to it), not from scratch
+    * previous_steps: tuple shared by all examples made before the next step,
+      so never modify it (or its steps) in place
+    * error_tags: tags of errors in previous_steps
+
+    """
+
+    def __init__(self, index: RecipeIndex):
+        self.index = index
+        self.passed = index.to_mask([0])  # start
+        self.next = index.get_next_mask(self.passed)
+        self.missing = index.get_missing_mask(self.passed)
+        self.previous_steps = ()
+        self.error_tags = frozenset()
+
+    def add(self, step_id: int) -> "RecordingState":
+        """return a new state where step_id is passed"""
+        index = self.index
+        state = copy(self)
+        bit = index.node2bit.get(step_id, 0)
+        if step_id == 0:
+            logging.warning("start found in passed steps")
+        if not bit or (bit & self.passed):
+            return state
+
+        idx = bit.bit_length() - 1
+        state.passed = passed = self.passed | bit
+        todo = index.get_todo_mask(passed)
+
+        # ancestors now have a passed descendant; only successors can be unlocked
+        state.next = self.next & ~bit & ~index.ancestors[idx]
+        for _idx in index.iter_bits(index.successors[idx] & todo):
+            if index.is_next(_idx, passed):
+                state.next |= 1 << _idx
+
+        # only steps connected to step_id can newly have passed ancestor/descendant
+        state.missing = self.missing & ~bit
+        for _idx in index.iter_bits(
+            (index.ancestors[idx] | index.descendants[idx]) & todo
+        ):
+            if index.is_missing(_idx, passed):
+                state.missing |= 1 << _idx
+
+        return state
+
+    def append(self, step: dict) -> "RecordingState":
+        """return a new state where step is added to previous steps"""
+        state = self.add(step["step_id"])
+        state.previous_steps = self.previous_steps + (step,)
+        state.error_tags = self.error_tags | {x["tag"] for x in step.get("errors", [])}
+        return state
+
+    def check_errors(self, exclude_types=()) -> bool:
+        """same as check_errors(previous_steps, exclude_types)"""
+        return not self.error_tags.issubset(exclude_types)
+
+
 def get_activity_name2recipe(dirpath: Path):
     """
     return mapping from activity name (lowercase, no space) to recipe graph
+    * index: compiled graph for next/missing step queries
 
     """
 
     name2recipe = {}
     for filepath in dirpath.glob("*.json"):
-        with open(filepath, "r") as f:
-            data = json.load(f)
+        data = load_json(filepath)
 
         G = nx.DiGraph()
         G.add_edges_from(data["edges"])
+        steps = {int(k): v for k, v in data["steps"].items()}
         name2recipe[filepath.stem] = {
             "graph": G,
-            "steps": {int(k): v for k, v in data["steps"].items()},
+            "steps": steps,
+            "index": RecipeIndex(G, steps),
         }
 
     return name2recipe
@@ -48,8 +182,7 @@ def get_video_metadata(filepath) -> dict:
 
     """
 
-    with open(filepath, "r") as f:
-        examples = json.load(f)
+    examples = load_json(filepath)
 
     id2bool = {}
     for idx, example in examples.items():
@@ -69,36 +202,15 @@ def get_next_steps(
     * passed_steps may or may not be completed
 
     """
-    next_steps = []
-    G = recipe["graph"]
+    index = recipe["index"]
     if 0 not in passed_steps:
-        passed_steps = deepcopy(passed_steps)
-        passed_steps.append(0)
+        passed_steps = list(passed_steps) + [0]
     else:
         logging.warning("start found in passed steps")
 
-    for node in G.nodes:
-        if recipe["steps"][node] == "END":
-            continue
-        if node not in passed_steps:
-            # check if all predecessors of this node are in passes_steps
-            all_predecessors_passed = all(
-                pred in passed_steps for pred in G.predecessors(node)
-            )
-            # check if no succeeding step is passed
-            # otherwise missing steps would be added as next steps
-            succeeding_step_found = any(
-                pred in passed_steps for pred in nx.descendants(G, node)
-            )
-
-            if all_predecessors_passed and not succeeding_step_found:
-                next_steps.append(node)
-
-    next_steps_w_description = [
-        {"step_id": x, "description": recipe["steps"][x]} for x in next_steps
-    ]
+    next_steps = index.to_step_ids(index.get_next_mask(index.to_mask(passed_steps)))
 
-    return next_steps_w_description
+    return add_description(recipe, next_steps)
 
 
 def get_missing_steps(
@@ -114,33 +226,21 @@ def get_missing_steps(
     * passed_steps may or may not be correctly completed
 
     """
-    G = recipe["graph"]
+    index = recipe["index"]
     if 0 not in passed_steps:
-        passed_steps = deepcopy(passed_steps)
-        passed_steps.append(0)
+        passed_steps = list(passed_steps) + [0]
     else:
         logging.warning("start found in passed steps")
 
-    missing_steps = []
-    for node in G.nodes:
-        if recipe["steps"][node] == "END":
-            continue
-        if node not in passed_steps:
-            # check if at least one preceding step and one succeeding step are passed
-            preceding_step_found = any(
-                pred in passed_steps for pred in nx.ancestors(G, node)
-            )
-            succeeding_step_found = any(
-                pred in passed_steps for pred in nx.descendants(G, node)
-            )
-            if preceding_step_found and succeeding_step_found:
-                missing_steps.append(node)
+    missing_steps = index.to_step_ids(
+        index.get_missing_mask(index.to_mask(passed_steps))
+    )
 
-    missing_steps_w_description = [
-        {"step_id": x, "description": recipe["steps"][x]} for x in missing_steps
-    ]
+    return add_description(recipe, missing_steps)
 
-    return missing_steps_w_description
+
+def add_description(recipe, step_ids) -> list[dict]:
+    return [{"step_id": x, "description": recipe["steps"][x]} for x in step_ids]
 
 
 def check_if_this_is_missing_step(step) -> bool:
@@ -204,35 +304,55 @@ def check_end_time(examples) -> None:
 #     return False
 
 
-def check_overlap(
-    idx: int, current_end_time: float, steps: list, margin: float = 2
-) -> bool:
+class StepIntervals:
     """
-    check if the current step overlaps with any of the following steps
-    margin: ignore potential small annotation artifact
+    interval index of one recording's steps, built once in O(#steps)
+    * latest_end[i]: latest end time among steps[: i + 1] (prefix max)
+    * earliest_start[i]: earliest (margin-adjusted) start among steps[i:] that
+      can overlap, i.e., valid & start < end (suffix min)
+
+    note:
+    * the trimmed video of a step is [0, end time], so any following step
+      overlaps with it iff the earliest start of them is before the end time
 
     """
-    current_start_time = 0.0
-    for step in steps[idx + 1 :]:
+
+    def __init__(self, steps: list, margin: float = 2):
+        self.latest_end = []
+        latest_end = -math.inf
+        for step in steps:
+            latest_end = max(latest_end, step["end_time"])
+            self.latest_end.append(latest_end)
+
+        self.earliest_start = [math.inf] * (len(steps) + 1)
+        for idx in range(len(steps) - 1, -1, -1):
+            start = self.get_start_time(steps[idx], margin)
+            if start is not None and start < steps[idx]["end_time"]:
+                self.earliest_start[idx] = min(self.earliest_start[idx + 1], start)
+            else:
+                self.earliest_start[idx] = self.earliest_start[idx + 1]
+
+    @staticmethod
+    def get_start_time(step, margin: float) -> Optional[float]:
+        """start time w/ margin to ignore small annotation artifact"""
         if check_if_this_is_missing_step(step):
-            continue
+            return None
         if step["end_time"] < 5:
-            continue
+            return None
 
-        # check if a following step overlaps with the current trimmed video
         duration = step["end_time"] - step["start_time"]
         if duration < 2:
-            if max(current_start_time, step["start_time"] + duration * 0.9) < min(
-                current_end_time, step["end_time"]
-            ):
-                return True
+            return max(0.0, step["start_time"] + duration * 0.9)
         else:
-            if max(current_start_time, step["start_time"] + margin) < min(
-                current_end_time, step["end_time"]
-            ):
-                return True
+            return max(0.0, step["start_time"] + margin)
 
-    return False
+    def check_overlap(self, idx: int, current_end_time: float) -> bool:
+        """check if the current step overlaps with any of the following steps"""
+        return self.earliest_start[idx + 1] < current_end_time
+
+    def get_end_time(self, idx: int) -> float:
+        """identify the latest end time in prevs + current"""
+        return self.latest_end[idx]
 
 
 def format2hhmmss(time):
@@ -244,29 +364,17 @@ def format2hhmmss(time):
     return f"{h:02}:{m:02}:{s:02}"
 
 
-def get_end_time(idx: int, steps: list) -> float:
-    """
-    identify the latest end time in prevs + current
-
-    """
-    end_time = steps[idx]["end_time"]
-    for step in steps[:idx]:
-        if end_time < step["end_time"]:
-            # logging.debug(
-            #     "one of prev ends later than the current, so we use the later one: "
-            #     f"{end_time} -> {step['end_time']}"
-            # )
-            end_time = step["end_time"]
-
-    return end_time
-
-
 def sanity_check_order_error(
     recording_id,
     step,
-    recipe,
-    previous_steps,
+    state,
+    state_w_step,
 ):
+    """
+    warn order error annotations w/o missing steps
+    * state/state_w_step: RecordingState w/o & w/ this step
+
+    """
     order_error = None
     if "errors" in step:
         for error in step["errors"]:
@@ -288,30 +396,18 @@ def sanity_check_order_error(
         ("13_41", 4),
     ]
 
-    missing_steps_before_this_step = get_missing_steps(
-        recipe,
-        # not adding the current step
-        [x["step_id"] for x in previous_steps],
-    )
-    missing_steps_after_this_step = get_missing_steps(
-        recipe,
-        [x["step_id"] for x in previous_steps] + [step["step_id"]],
-    )
-
     # sanity check: if missing step is included here
-    if (
-        len(missing_steps_before_this_step) == 0
-        and len(missing_steps_after_this_step) == 0
-    ):
+    if state.missing == 0 and state_w_step.missing == 0:
         if (recording_id, step["step_id"]) in exceptions:
             pass
         elif not order_error:
             pass
         else:
-            print(order_error)
+            # note: not print(), stdout can be the output stream
             logging.warning(
                 "Order error annotation w/o missing steps "
-                f"recording id: {recording_id}, step: {step['step_id']}"
+                f"recording id: {recording_id}, step: {step['step_id']} "
+                f"({order_error})"
             )
 
 
@@ -353,6 +449,89 @@ def get_target_description(step, error_type):
     return error_description
 
 
+def index_errors(step) -> dict:
+    """
+    return mapping from error tag to error, in one pass over step's errors
+    * the last one is kept if a tag appears twice, as in get_target_description
+
+    """
+    return {error["tag"]: error for error in step.get("errors", [])}
+
+
+class QuestionRule(NamedTuple):
+    """
+    how to create one question type from a step
+    * is_eligible: (step, tag2error) -> if the question is created
+    * exclude_types: error tags in previous steps not counted as noise
+    * build: (recipe, state_w_step, tag2error) -> type-specific fields
+
+    """
+
+    is_eligible: Callable[[dict, dict], bool]
+    exclude_types: tuple[str, ...]
+    build: Callable[[dict, "RecordingState", dict], dict]
+
+
+def is_not_start(step, tag2error) -> bool:
+    return step["step_id"] > 0
+
+
+def has_error(error_type):
+    """eligible if not start step & the step has error_type"""
+
+    def is_eligible(step, tag2error) -> bool:
+        return step["step_id"] > 0 and error_type in tag2error
+
+    return is_eligible
+
+
+def build_error_description(error_type):
+    def build(recipe, state_w_step, tag2error) -> dict:
+        return {"error_description": tag2error[error_type]["description"]}
+
+    return build
+
+
+def error_rule(error_type, exclude_types=()) -> QuestionRule:
+    return QuestionRule(
+        is_eligible=has_error(error_type),
+        exclude_types=exclude_types,
+        build=build_error_description(error_type),
+    )
+
+
+# question type -> rule, in the order of examples in the output
+# note:
+# * next: created even for the last step, then the answer would be none
+# * missing: created even if no missing step exists, then the answer would be none
+QUESTION_RULES = {
+    "next": QuestionRule(
+        is_eligible=lambda step, tag2error: True,
+        exclude_types=(),
+        build=lambda recipe, state_w_step, tag2error: {
+            "next_steps": add_description(
+                recipe, recipe["index"].to_step_ids(state_w_step.next)
+            )
+        },
+    ),
+    "missing": QuestionRule(
+        is_eligible=is_not_start,
+        exclude_types=("Missing Step",),
+        build=lambda recipe, state_w_step, tag2error: {
+            "missing_steps": add_description(
+                recipe, recipe["index"].to_step_ids(state_w_step.missing)
+            )
+        },
+    ),
+    "order": error_rule("Order Error", ("Order Error", "Missing Step")),
+    "preparation": error_rule("Preparation Error"),
+    "measurement": error_rule("Measurement Error"),
+    "timing": error_rule("Timing Error"),
+    "technique": error_rule("Technique Error"),
+    "temperature": error_rule("Temperature Error"),
+}
+
+
 def check_if_target_verb(step, _type, type2verbs) -> bool:
     """check if this step can be a error of this type"""
 
@@ -0,0 +1,86 @@
+"""
+Read & write examples for preprocessing stages
+
+* JSON (a list of examples) or JSONL (one example per line), by file suffix
+* "-": stdin/stdout as JSONL, to chain stages through a pipe, e.g.,
+    python create_example.py ... --filepath_output -
+        | python sample.py --filepath_input - ...
+* JSON codec: see src/json_codec.py
+
+"""
+
+from itertools import islice
+from pathlib import Path
+import sys
+from typing import Iterable, Iterator
+
+# shared JSON codec in src/, also re-exported for scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import dumps_json, loads_json, load_json, save_json  # noqa: E402, F401
+
+STDIO = "-"
+
+
+def is_jsonl(filepath: Path) -> bool:
+    return str(filepath) == STDIO or Path(filepath).suffix == ".jsonl"
+
+
+def iter_jsonl(f) -> Iterator[dict]:
+    for line in f:
+        if line.strip():
+            yield loads_json(line)
+
+
+def iter_examples(filepath: Path) -> Iterator[dict]:
+    """
+    yield examples one by one
+    * JSONL is streamed, i.e., one line in memory at a time
+    * JSON is loaded at once, for compatibility
+
+    """
+    if str(filepath) == STDIO:
+        yield from iter_jsonl(sys.stdin.buffer)
+    elif is_jsonl(filepath):
+        with open(filepath, "rb") as f:
+            yield from iter_jsonl(f)
+    else:
+        yield from load_json(filepath)
+
+
+def load_examples(filepath: Path) -> list[dict]:
+    return list(iter_examples(filepath))
+
+
+def save_examples(
+    examples: Iterable[dict], filepath: Path, pretty: bool = False
+) -> int:
+    """
+    write examples, return #examples
+    * JSONL is written as examples come, always compact
+    * JSON is compact, or indented if pretty
+
+    """
+    count = 0
+    if is_jsonl(filepath):
+        f = sys.stdout.buffer if str(filepath) == STDIO else open(filepath, "wb")
+        try:
+            for example in examples:
+                f.write(dumps_json(example) + b"\n")
+                count += 1
+            f.flush()
+        finally:
+            if f is not sys.stdout.buffer:
+                f.close()
+    else:
+        examples = list(examples)
+        save_json(examples, filepath, pretty=pretty)
+        count = len(examples)
+
+    return count
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """split into lists of size, to bound memory w/ a process pool"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
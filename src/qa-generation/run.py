@@ -4,89 +4,216 @@ Explore templates for calling LLM API to generate question-answer pairs
 """
 
 from argparse import ArgumentParser
-from copy import deepcopy
-import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 from pathlib import Path
+import threading
+import time
+from tqdm import tqdm
 import yaml
 from utils import (
     get_date,
     load_recipe,
-    load_frame,
+    FrameLoader,
     get_text_content,
     get_image_content,
     # call_openai_api,
-    call_api,
-    save_data,
+    call_api_candidates,
+    get_generation,
+    get_rng,
+    load_checkpoint,
+    dumps_json,
+    load_json,
+    save_json,
+    estimate_cost,
+    get_response_format,
+    QA_SCHEMA,
 )
 
 
+def prepare_run(
+    args,
+    model_id: str,
+    template_type: str,
+    examples: list[dict],
+    template_components: dict,
+    name2recipe: dict,
+) -> dict:
+    """
+    prepare text prompts, checkpoint, and output path of one (model, template)
+
+    """
+    # structured-output mode: ask for JSON instead of a markdown list
+    response_format = None
+    if args.structured_output:
+        response_format = get_response_format(model_id, "qas", QA_SCHEMA)
+    components = template_components
+    if response_format:
+        components = template_components | {
+            "constraint": template_components["constraint_structured"],
+            "example": template_components["example_structured"],
+        }
+
+    filepath_output = (
+        args.dirpath_output
+        / f"{Path(model_id).name}_{template_type}_{args.filepath_input.name}"
+        # args.dirpath_output / f"{args.filepath_input.name}"
+    )
+    # each finished example is appended here, one JSON per line
+    filepath_checkpoint = filepath_output.with_suffix(".jsonl")
+    if args.resume:
+        question_id2finished = load_checkpoint(filepath_checkpoint)
+        logging.info(
+            f"Resume {filepath_output.name}: "
+            f"{len(question_id2finished)} finished examples found"
+        )
+    else:
+        question_id2finished = {}
+        filepath_checkpoint.unlink(missing_ok=True)
+
+    logging.info(f"{model_id=}, {template_type=}")
+    contents, prompts, indices = [], [], []
+    for idx, example in enumerate(examples):
+        # text part
+        content, text_prompt = get_text_content(
+            components=components,
+            template_type=template_type,
+            example=example,
+            name2recipe=name2recipe,
+        )
+        contents.append(content)
+        # examples are not copied, results are joined when saved
+        prompts.append(text_prompt)
+
+        if example["question_id"] not in question_id2finished:
+            indices.append(idx)
+
+    # check
+    logging.info("[sanity check] contents[1][0]['text']=")
+    logging.info(contents[1][0]["text"])
+    logging.info(f"#requests: {len(indices)}/{len(examples)}")
+
+    return {
+        "model_id": model_id,
+        "template_type": template_type,
+        "response_format": response_format,
+        "wait_time": 1 if "video" in template_type else 0.5,
+        "contents": contents,
+        "prompts": prompts,
+        "indices": indices,
+        "question_id2finished": question_id2finished,
+        "filepath_output": filepath_output,
+        "filepath_checkpoint": filepath_checkpoint,
+        "count_tokens": defaultdict(int),
+    }
+
+
 def main(args):
-    with open(args.filepath_input, "r") as f:
-        examples = json.load(f)
+    examples = load_json(args.filepath_input)
 
     # load template
     with open(args.filepath_template, "r") as f:
         template_components = yaml.safe_load(f)
 
+    # shared by all (model, template) runs
     name2recipe = load_recipe(args.filepath_graph, args.dirpath_recipe_image)
 
-    # load user recording as frames
-    if "video" in args.template_type:
-        id2sample = load_frame(args.dirpath_frames, args.max_frames)
+    # load user recording as frames (lazily, when each message is built)
+    if any("video" in x for x in args.template_type):
+        id2sample = FrameLoader(
+            args.dirpath_frames, args.max_frames, args.frame_cache_size
+        )
 
-    logging.info(f"{args.template_type=}")
-    messages_list, indices = [], []
-    new_examples = []
-    for idx, example in enumerate(examples):
-        # text part
-        content, text_prompt = get_text_content(
-            components=template_components,
-            template_type=args.template_type,
-            example=example,
+    runs = [
+        prepare_run(
+            args,
+            model_id=model_id,
+            template_type=template_type,
+            examples=examples,
+            template_components=template_components,
             name2recipe=name2recipe,
         )
+        for model_id in args.model_id
+        for template_type in args.template_type
+    ]
+
+    lock = threading.Lock()
+
+    def generate(run: dict, idx: int) -> None:
+        """build message, call API, postprocess, and save one example"""
+        content = run["contents"][idx]
         # add image part if applicable
-        if "video" in args.template_type:
-            content += get_image_content(
+        if "video" in run["template_type"]:
+            content = content + get_image_content(
                 id2sample=id2sample,
-                example=example,
+                example=examples[idx],
                 name2recipe=name2recipe,
-                template_type=args.template_type,
+                template_type=run["template_type"],
             )
-        messages_list.append({"role": "user", "content": content})
-        indices.append(idx)
+        responses, tokens = call_api_candidates(
+            model_id=run["model_id"],
+            messages={"role": "user", "content": content},
+            num_candidates=args.num_candidates,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            wait_time=run["wait_time"],
+            response_format=run["response_format"],
+            max_retries=args.max_retries,
+        )
+        record = get_generation(
+            examples[idx],
+            prompt=run["prompts"][idx],
+            model_id=run["model_id"],
+            template_type=run["template_type"],
+            responses=responses,
+            structured_output=run["response_format"] is not None,
+            rng=get_rng(args.seed, examples[idx]["question_id"]),
+        )
+        with lock:
+            run["count_tokens"]["input"] += tokens["input"]
+            run["count_tokens"]["output"] += tokens["output"]
+            with open(run["filepath_checkpoint"], "ab") as f:
+                f.write(dumps_json(record) + b"\n")
+        time.sleep(run["wait_time"])
 
-        new_example = deepcopy(example)
-        new_example["generation"] = {"prompt": text_prompt}
-        new_examples.append(new_example)
+    # example-major order so that runs for the same example share cached frames
+    tasks = sorted(
+        [(idx, run_id) for run_id, run in enumerate(runs) for idx in run["indices"]]
+    )
+    logging.info(f"API call starts (#tasks: {len(tasks)}, {args.num_workers=})")
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {
+            executor.submit(generate, runs[run_id], idx): (idx, run_id)
+            for idx, run_id in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                idx, run_id = futures[future]
+                logging.error(
+                    f"Failed: {examples[idx]['question_id']} "
+                    f"({runs[run_id]['filepath_output'].name}, {e})"
+                )
 
-    # check
-    logging.info("[sanity check] messages_list[1]['content'][0]['text']=")
-    logging.info(messages_list[1]["content"][0]["text"])
-    logging.info(f"#requests: {len(messages_list)}/{len(examples)}")
+    for run in runs:
+        logging.info(f"[{run['filepath_output'].name}]")
+        estimate_cost(run["model_id"], run["count_tokens"])
 
-    logging.info("API call starts")
-    responses, cost = call_api(
-        model_id=args.model_id,
-        messages_list=messages_list,
-        temperature=args.temperature,
-        max_tokens=args.max_tokens,
-        wait_time=1 if "video" in args.template_type else 0.5,
-    )
+        # join finished records (incl. previous runs) w/ examples in the input order
+        question_id2finished = run["question_id2finished"] | load_checkpoint(
+            run["filepath_checkpoint"]
+        )
+        outputs = []
+        for example, prompt in zip(examples, run["prompts"]):
+            record = question_id2finished.get(
+                example["question_id"], {"generation": {"prompt": prompt}}
+            )
+            outputs.append(example | record)
+        logging.info(f"#finished: {len(question_id2finished)}/{len(examples)}")
 
-    save_data(
-        model_id=args.model_id,
-        template_type=args.template_type,
-        examples=new_examples,
-        responses=responses,
-        indices=indices,
-        filepath_output=(
-            args.dirpath_output
-            / f"{Path(args.model_id).name}_{args.template_type}_{args.filepath_input.name}"
-            # args.dirpath_output / f"{args.filepath_input.name}"
-        ),
-    )
+        save_json(outputs, run["filepath_output"], pretty=args.pretty)
 
 
 if __name__ == "__main__":
@@ -125,19 +252,55 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model_id",
         type=str,
-        help="model_id",
+        nargs="+",
+        help="model_id(s), sweep over all if multiple",
     )
     parser.add_argument(
         "--template_type",
         type=str,
-        help="template_type",
+        nargs="+",
+        help="template_type(s), sweep over all if multiple",
     )
     parser.add_argument("--temperature", type=float, help="temperature", default=0.7)
     parser.add_argument(
         "--max_tokens", type=int, help="max tokens to generate", default=512
     )
     parser.add_argument("--max_frames", type=int, help="max frames to feed", default=50)
+    parser.add_argument(
+        "--frame_cache_size",
+        type=int,
+        help="max #recordings whose encoded frames are kept in memory",
+        default=8,
+    )
+    parser.add_argument(
+        "--num_workers", type=int, help="max #concurrent API calls", default=1
+    )
+    parser.add_argument(
+        "--num_candidates",
+        type=int,
+        help="#candidate generations per example, the best-scored one is kept",
+        default=1,
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip examples already finished in the checkpoint (by question_id)",
+    )
     parser.add_argument("--seed", type=int, help="random seed", default=42)
+    parser.add_argument(
+        "--structured_output",
+        action="store_true",
+        help="request JSON output following a schema, if supported",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        help="max #retries for an invalid/failed response",
+        default=0,
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", help="write indented JSON (default: compact)"
+    )
     parser.add_argument("--dirpath_log", type=Path, help="dirpath for log")
 
     args = parser.parse_args()
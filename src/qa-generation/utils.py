@@ -4,21 +4,27 @@ utils functions
 """
 
 import base64
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 import json
-from litellm import completion
+from litellm import completion, get_supported_openai_params, supports_response_schema
 import logging
 from openai import OpenAI
 import os
 from pathlib import Path
 import pydot
 import re
+import sys
+import threading
 import time
-from tqdm import tqdm
 import random
 from typing import Any, Optional
 
+# shared modules in src/, the JSON codec is also re-exported for scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import dumps_json, loads_json, load_json, save_json  # noqa: E402, F401
+from utils_frame import extract_index, open_archive, sample_frame_ids  # noqa: E402
+
 
 PRICE = {
     "gpt-4o": {
@@ -44,6 +50,27 @@ PRICE = {
     },
 }
 
+# JSON schema for structured-output mode: three QAs, each w/ a list of answers
+QA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "qas": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "question": {"type": "string"},
+                    "answers": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["question", "answers"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["qas"],
+    "additionalProperties": False,
+}
+
 
 def get_date(granularity: Optional[str] = "min") -> str:
     """
@@ -66,8 +93,7 @@ def load_recipe(filepath_graph, dirpath_recipe_image):
     for filepath in dirpath_recipe_image.glob("*.png"):
         id2image_path[filepath.stem] = filepath
 
-    with open(filepath_graph, "r") as f:
-        raw_graphs = json.load(f)
+    raw_graphs = load_json(filepath_graph)
     activity_name2recipe = {}
     for activity_id, graph in raw_graphs.items():
         G = pydot.Dot(graph_type="digraph")
@@ -97,52 +123,77 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
-def extract_index(filepath):
-    return int(re.search(r"\d+", filepath.stem).group())
+def sample_frame(dirpath_frames: Path, max_frames: int) -> dict:
+    """
+    sample & encode frames of one recording
+    * from <recording_id>.pack if it exists, otherwise from <recording_id>/*.png
 
+    """
+    filepath_archive = dirpath_frames.with_suffix(".pack")
+    archive = None
+    if filepath_archive.exists():
+        archive = open_archive(filepath_archive)
+        frame_ids = archive.frame_ids()
+    else:
+        frame_ids = sorted(extract_index(x) for x in dirpath_frames.glob("*.png"))
+    # positions (1-origin) in frame_ids, the last frame is always included
+    positions, rate_inverse = sample_frame_ids(len(frame_ids), max_frames)
+
+    sampled_frames = []
+    sampled_frames_idx = []
+    for position in positions:
+        frame_id = frame_ids[position - 1]
+        if archive:
+            sampled_frames.append(archive.encode(frame_id))
+        else:
+            sampled_frames.append(encode_image(dirpath_frames / f"{frame_id}.png"))
+        sampled_frames_idx.append(str(frame_id))
 
-def load_frame(dirpath: Path, max_frames: int) -> dict:
+    return {
+        "encode": sampled_frames,
+        "idx": sampled_frames_idx,
+        "rate_inverse": rate_inverse,
+    }
+
+
+class FrameLoader:
     """
-    load & sample frames
+    lazy & bounded replacement of an id -> sample dict
+    * frames of a recording are sampled & encoded only when accessed
+    * at most cache_size recordings are kept (least recently used is evicted)
 
     """
 
-    logging.info("load & sample frames")
-    id2sample = {}
-    for dirpath_frames in tqdm(dirpath.iterdir(), total=len(list(dirpath.iterdir()))):
-        if not dirpath_frames.is_dir():
-            continue
+    def __init__(self, dirpath: Path, max_frames: int, cache_size: int = 8):
+        self.dirpath = dirpath
+        self.max_frames = max_frames
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
 
-        filepaths_frame = list(dirpath_frames.glob("*.png"))
-        num_frames = len(filepaths_frame)
-        # e.g., 700 frames, max 250 => rate: 1 frame per every 3 frames
-        if num_frames > max_frames:
-            if num_frames % max_frames == 0:
-                rate_inverse = num_frames // max_frames
-            else:
-                rate_inverse = (num_frames // max_frames) + 1
-        else:
-            rate_inverse = 1
-        filepaths_frame_sorted = sorted(filepaths_frame, key=extract_index)
-
-        sampled_frames = []
-        sampled_frames_idx = []
-        # note: "reversed" to make sure the last frame is included in the input
-        for idx, filepath_frame in enumerate(reversed(filepaths_frame_sorted)):
-            # change sample rate
-            if idx % rate_inverse == 0:
-                sampled_frames.insert(0, encode_image(filepath_frame))
-                sampled_frames_idx.insert(0, filepath_frame.stem)
-
-        assert len(sampled_frames) <= max_frames
-
-        id2sample[dirpath_frames.stem] = {
-            "encode": sampled_frames,
-            "idx": sampled_frames_idx,
-            "rate_inverse": rate_inverse,
-        }
+    def __contains__(self, recording_id: str) -> bool:
+        return (self.dirpath / recording_id).is_dir() or (
+            self.dirpath / f"{recording_id}.pack"
+        ).exists()
+
+    def __getitem__(self, recording_id: str) -> dict:
+        with self.lock:
+            if recording_id in self.cache:
+                self.cache.move_to_end(recording_id)
+                return self.cache[recording_id]
+
+        dirpath_frames = self.dirpath / recording_id
+        if recording_id not in self:
+            raise KeyError(recording_id)
+        sample = sample_frame(dirpath_frames, self.max_frames)
 
-    return id2sample
+        with self.lock:
+            self.cache[recording_id] = sample
+            self.cache.move_to_end(recording_id)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return sample
 
 
 def format_steps(steps: list, w_error: bool = False) -> str:
@@ -434,7 +485,7 @@ def get_image_content(
     return content
 
 
-def postprocess(generation: str) -> dict[str, Any]:
+def postprocess(generation: str, rng: random.Random) -> dict[str, Any]:
     # specifically for gemini
     qas = []
     if generation:
@@ -451,7 +502,7 @@ def postprocess(generation: str) -> dict[str, Any]:
                     qa["answers"].append(_matches[0])
             qas.append(qa)
 
-        random.shuffle(qas)
+        rng.shuffle(qas)
 
     if len(qas) != 3:
         logging.warning(
@@ -464,6 +515,129 @@ def postprocess(generation: str) -> dict[str, Any]:
     return qas
 
 
+def parse_structured(generation: str, num_qas: int = 3) -> list[dict[str, Any]]:
+    """
+    parse & validate a response of the structured-output mode, w/o side effects
+    raise ValueError if the response does not follow QA_SCHEMA
+
+    """
+    try:
+        data = json.loads(generation)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+    if not isinstance(data, dict) or not isinstance(data.get("qas"), list):
+        raise ValueError(f"No qas found: {generation}")
+
+    qas = []
+    for qa in data["qas"]:
+        if (
+            not isinstance(qa, dict)
+            or not isinstance(qa.get("question"), str)
+            or not qa["question"].strip()
+            or not isinstance(qa.get("answers"), list)
+            or len(qa["answers"]) == 0
+            or not all(isinstance(x, str) and x.strip() for x in qa["answers"])
+        ):
+            raise ValueError(f"Invalid QA: {qa}")
+        qas.append(
+            {
+                "question": qa["question"].strip(),
+                "answers": [x.strip() for x in qa["answers"]],
+            }
+        )
+
+    if len(qas) != num_qas:
+        raise ValueError(f"{len(qas)} (!={num_qas}) QAs were returned")
+
+    return qas
+
+
+def postprocess_structured(
+    generation: str, rng: random.Random, num_qas: int = 3
+) -> list[dict[str, Any]]:
+    """
+    parse a response of the structured-output mode, in random order
+    raise ValueError if the response does not follow QA_SCHEMA
+
+    """
+    qas = parse_structured(generation, num_qas)
+    rng.shuffle(qas)
+
+    return qas
+
+
+def get_response_format(model_id: str, name: str, schema: dict) -> Optional[dict]:
+    """
+    return response_format for structured output if the backend supports it
+
+    """
+    if not supports_response_schema(model=model_id):
+        logging.warning(f"Structured output is not supported: {model_id=}")
+        return None
+
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": True},
+    }
+
+
+def tokenize(text: str) -> set[str]:
+    """lowercased content words (w/o very short ones) for rough overlap"""
+    return set(x for x in re.findall(r"[a-z]+", text.lower()) if len(x) > 2)
+
+
+def get_target_descriptions(example: dict) -> tuple[list[str], int]:
+    """
+    return target descriptions and expected #answers of an example
+
+    """
+    match example["type"]:
+        case "next" | "missing":
+            steps = example[f"{example['type']}_steps"]
+            descriptions = [x["description"] for x in steps]
+            num_answers = max(1, len(steps))
+        case _:
+            descriptions = [example["error_description"]]
+            num_answers = 1
+    return descriptions, num_answers
+
+
+def score_qa(qa: dict, example: dict) -> float:
+    """
+    score one QA w/ cheap heuristics
+    * #answers close to the #target steps
+    * concise question/answers
+    * answers overlap with target step/error descriptions
+
+    """
+    if not qa["question"] or not qa["answers"] or None in qa["answers"]:
+        return 0.0
+
+    descriptions, num_answers = get_target_descriptions(example)
+
+    score = 1.0
+    score -= 0.2 * abs(len(qa["answers"]) - num_answers)
+    if not 3 <= len(qa["question"].split()) <= 25:
+        score -= 0.2
+    score -= 0.1 * sum(len(x.split()) > 25 for x in qa["answers"])
+
+    tokens_target = set().union(*[tokenize(x) for x in descriptions])
+    if tokens_target:
+        tokens_answer = set().union(*[tokenize(x) for x in qa["answers"]])
+        score += 0.5 * len(tokens_answer & tokens_target) / len(tokens_target)
+
+    return max(score, 0.0)
+
+
+def score_qas(qas: list[dict], example: dict, num_qas: int = 3) -> float:
+    """score a candidate (list of QAs): mean QA score, penalized if #QAs != num_qas"""
+    if len(qas) == 0:
+        return 0.0
+    score = sum(score_qa(qa, example) for qa in qas) / len(qas)
+    return score * min(len(qas), num_qas) / max(len(qas), num_qas)
+
+
 def estimate_cost(model_id: str, count: dict[str, int]) -> float:
     """estimate cost"""
     cost = (
@@ -508,36 +682,243 @@ def call_openai_api(
     return responses
 
 
-def call_api(
+def call_api_single(
     model_id: str,
-    messages_list: list[str],
+    messages: dict,
     temperature: float,
     max_tokens: int,
     wait_time: int,
-) -> list[str]:
-    """call API via LiteLLM"""
+    response_format: Optional[dict] = None,
+    max_retries: int = 0,
+) -> tuple[str, dict[str, int]]:
+    """
+    call API via LiteLLM for one request
 
-    responses = []
-    count_tokens = defaultdict(int)
-    for messages in messages_list:
+    note:
+    * w/ response_format, the response is validated on receipt and
+      the request is retried (up to max_retries) if it is invalid
+
+    """
+
+    output = "Error"
+    tokens = defaultdict(int)
+    for num_trial in range(max_retries + 1):
         try:
             response = completion(
                 model=model_id,
                 messages=[messages],
                 temperature=temperature,
                 max_tokens=max_tokens,
+                response_format=response_format,
             )
-            responses.append(response.choices[0].message.content)
-            count_tokens["input"] += response.usage.prompt_tokens
-            count_tokens["output"] += response.usage.completion_tokens
         except Exception as e:
-            responses.append("Error")
             logging.info(f"Exception: {e}")
-        time.sleep(wait_time)
+            if num_trial < max_retries:
+                time.sleep(wait_time)
+            continue
+
+        output = response.choices[0].message.content
+        tokens["input"] += response.usage.prompt_tokens
+        tokens["output"] += response.usage.completion_tokens
+        if not response_format:
+            break
+        try:
+            parse_structured(output)
+            break
+        except ValueError as e:
+            logging.warning(f"Invalid structured output ({num_trial=}): {e}")
+
+    return output, tokens
+
+
+def call_api_candidates(
+    model_id: str,
+    messages: dict,
+    num_candidates: int,
+    temperature: float,
+    max_tokens: int,
+    wait_time: int,
+    response_format: Optional[dict] = None,
+    max_retries: int = 0,
+) -> tuple[list[str], dict[str, int]]:
+    """
+    call API via LiteLLM for num_candidates samples of one request
+    * one call w/ `n` if the backend supports it
+    * otherwise, one call after another, not to exceed the #workers of run.py
 
-    cost = estimate_cost(model_id, count_tokens)
+    """
+
+    kwargs = {
+        "model_id": model_id,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "wait_time": wait_time,
+        "response_format": response_format,
+        "max_retries": max_retries,
+    }
+    if num_candidates == 1:
+        output, tokens = call_api_single(**kwargs)
+        return [output], tokens
+
+    if "n" not in (get_supported_openai_params(model=model_id) or []):
+        outputs = []
+        tokens = defaultdict(int)
+        for _ in range(num_candidates):
+            output, _tokens = call_api_single(**kwargs)
+            outputs.append(output)
+            tokens["input"] += _tokens["input"]
+            tokens["output"] += _tokens["output"]
+        return outputs, tokens
+
+    outputs = ["Error"] * num_candidates
+    tokens = defaultdict(int)
+    for num_trial in range(max_retries + 1):
+        try:
+            response = completion(
+                model=model_id,
+                messages=[messages],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                response_format=response_format,
+                n=num_candidates,
+            )
+        except Exception as e:
+            logging.info(f"Exception: {e}")
+            if num_trial < max_retries:
+                time.sleep(wait_time)
+            continue
 
-    return responses, cost
+        outputs = [x.message.content for x in response.choices]
+        tokens["input"] += response.usage.prompt_tokens
+        tokens["output"] += response.usage.completion_tokens
+        if not response_format:
+            break
+        # retry only if none of the candidates is valid
+        num_valid = 0
+        for output in outputs:
+            try:
+                parse_structured(output)
+                num_valid += 1
+            except ValueError:
+                pass
+        if num_valid > 0:
+            break
+        logging.warning(f"No valid structured output ({num_trial=})")
+
+    return outputs, tokens
+
+
+def get_rng(seed: int, question_id: str) -> random.Random:
+    """random generator for one example, deterministic given the seed"""
+    return random.Random(f"{seed}_{question_id}")
+
+
+def get_generation(
+    example: dict,
+    prompt: Optional[str],
+    model_id: str,
+    template_type: str,
+    responses: list[str],
+    structured_output: bool = False,
+    rng: Optional[random.Random] = None,
+) -> dict:
+    """
+    return a (postprocessed) response as a record keyed by question id,
+    to be joined w/ the example when saved, i.e., example | record
+    * w/ multiple candidate responses, keep the best-scored one and
+      sort its QAs by score so that the best one is used as question/answers
+    * rng: for QA order, one per example so that it does not depend on
+      thread scheduling, e.g., get_rng(seed, question_id)
+    * the example itself is not modified
+
+    """
+    rng = rng or random.Random()
+    candidates = []
+    for response in responses:
+        if structured_output:
+            try:
+                qas = postprocess_structured(response, rng)
+            except ValueError as e:
+                logging.warning(f"Invalid structured output: {e}")
+                qas = [{"question": None, "answers": [None]}]
+        else:
+            qas = postprocess(response, rng)
+            rng.shuffle(qas)
+        candidates.append((response, qas))
+
+    generation = {"prompt": prompt}
+    if len(candidates) > 1:
+        scores = [score_qas(qas, example) for _, qas in candidates]
+        best = max(range(len(candidates)), key=lambda x: scores[x])
+        generation["candidates"] = [
+            {"response": response, "score": score}
+            for (response, _), score in zip(candidates, scores)
+        ]
+        response, qas = candidates[best]
+        qas = sorted(qas, key=lambda x: score_qa(x, example), reverse=True)
+    else:
+        response, qas = candidates[0]
+    generation["response"] = response
+    generation["model_id"] = model_id
+    generation["template_type"] = template_type
+    generation["qas"] = qas
+
+    return {
+        "question_id": example["question_id"],
+        "generation": generation,
+        "question": qas[0]["question"],
+        "answers": qas[0]["answers"],
+    }
+
+
+def attach_generation(
+    example: dict,
+    model_id: str,
+    template_type: str,
+    responses: list[str],
+    structured_output: bool = False,
+) -> dict:
+    """attach a (postprocessed) response to an example, in place"""
+    prompt = example.get("generation", {}).get("prompt")
+    example.update(
+        get_generation(
+            example,
+            prompt=prompt,
+            model_id=model_id,
+            template_type=template_type,
+            responses=responses,
+            structured_output=structured_output,
+        )
+    )
+
+    return example
+
+
+def load_checkpoint(filepath: Path) -> dict[str, dict]:
+    """
+    load finished records (one JSON per line) for resuming
+    * records are from get_generation(), or full examples in older checkpoints,
+      either of which can be joined w/ the example, i.e., example | record
+    * failed API calls ("Error") are not regarded as finished
+
+    """
+    question_id2record = {}
+    if not filepath.exists():
+        return question_id2record
+
+    with open(filepath, "rb") as f:
+        for line in f:
+            try:
+                record = loads_json(line)
+            except ValueError:
+                # e.g., the last line written when interrupted
+                logging.warning(f"Skip broken line in checkpoint: {line[:100]}")
+                continue
+            if record["generation"]["response"] != "Error":
+                question_id2record[record["question_id"]] = record
+
+    return question_id2record
 
 
 def save_data(
@@ -547,31 +928,26 @@ def save_data(
     responses: list[str],
     indices: list[int],
     filepath_output: Path,
+    structured_output: bool = False,
+    pretty: bool = False,
 ) -> None:
     try:
         # combine input&output
         if len(examples) != len(responses):
             logging.error(f"{len(examples)=} != {len(responses)=}")
         for idx, response in zip(indices, responses):
-            if "generation" not in examples[idx]:
-                examples[idx]["generation"] = {"prompt": None}
-            examples[idx]["generation"]["response"] = response
-            examples[idx]["generation"]["model_id"] = model_id
-            examples[idx]["generation"]["template_type"] = template_type
-            qas = postprocess(response)
-            random.shuffle(qas)
-            examples[idx]["generation"]["qas"] = qas
-            examples[idx]["question"] = qas[0]["question"]
-            examples[idx]["answers"] = qas[0]["answers"]
+            attach_generation(
+                examples[idx],
+                model_id=model_id,
+                template_type=template_type,
+                responses=[response],
+                structured_output=structured_output,
+            )
         # save combined version
-        with open(filepath_output, "w") as f:
-            json.dump(examples, f, indent=4)
-            f.write("\n")
+        save_json(examples, filepath_output, pretty=pretty)
     except Exception as e:
         logging.error(f"Error while saving: {e}")
         # save generation as is
-        with open(filepath_output, "w") as f:
-            json.dump(responses, f, indent=4)
-            f.write("\n")
+        save_json(responses, filepath_output, pretty=pretty)
 
     return None
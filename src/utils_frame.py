@@ -0,0 +1,215 @@
+"""
+frame helpers shared by all stages, w/o API clients, i.e., numpy & the
+standard library only
+
+* packed frames: written by src/benchmark/pack_frame.py
+* frame index (signatures & phashes): built by src/benchmark/sample_frame.py
+* frame id sampling: uniform, adaptive, & near-duplicate removal
+
+"""
+
+import base64
+from functools import lru_cache
+import json
+import mmap
+import numpy as np
+from pathlib import Path
+import re
+import struct
+from typing import NamedTuple, Optional
+
+
+# packed frames (<recording_id>.pack):
+#   PACK_MAGIC | png | png | ... | index (json: frame id -> [offset, length]) | footer
+PACK_MAGIC = b"PROMQAF1"
+PACK_FOOTER = struct.Struct("<QQ8s")  # index offset, index length, PACK_MAGIC
+
+
+class FrameArchive:
+    """
+    read-only, memory-mapped packed frames of one recording
+    * each frame is sliced from the mmap w/o copy
+
+    """
+
+    def __init__(self, filepath: Path):
+        self.filepath = filepath
+        with open(filepath, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length, magic = PACK_FOOTER.unpack_from(
+            self.mm, len(self.mm) - PACK_FOOTER.size
+        )
+        if magic != PACK_MAGIC or self.mm[: len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f"Invalid frame archive: {filepath}")
+        index = json.loads(self.mm[offset : offset + length])
+        self.id2span = {int(k): v for k, v in index.items()}
+
+    def frame_ids(self) -> list[int]:
+        return sorted(self.id2span)
+
+    def get(self, frame_id: int) -> memoryview:
+        offset, length = self.id2span[frame_id]
+        return memoryview(self.mm)[offset : offset + length]
+
+    def encode(self, frame_id: int) -> str:
+        return base64.b64encode(self.get(frame_id)).decode("utf-8")
+
+
+class PackedFrame(NamedTuple):
+    archive: FrameArchive
+    frame_id: int
+
+
+@lru_cache(maxsize=32)
+def open_archive(filepath: Path) -> FrameArchive:
+    return FrameArchive(filepath)
+
+
+def extract_index(filepath):
+    return int(re.search(r"\d+", filepath.stem).group())
+
+
+def convert_time(time: str) -> int:
+    hh, mm, ss = time.split(":")
+    return int(mm) * 60 + int(ss)
+
+
+def sample_frame_ids(num_frames: int, max_frames: int) -> tuple[list[int], int]:
+    """
+    sample at most max_frames frame ids out of 1, ..., num_frames
+
+    """
+    # e.g., 700 frames, max 250 => rate: 1 frame per every 3 frames
+    if num_frames > max_frames:
+        if num_frames % max_frames == 0:
+            rate_inverse = num_frames // max_frames
+        else:
+            rate_inverse = (num_frames // max_frames) + 1
+    else:
+        rate_inverse = 1
+
+    # note: from the last one to make sure the last frame is included in the input
+    frame_ids = list(range(num_frames, 0, -rate_inverse))[::-1]
+
+    assert len(frame_ids) <= max_frames
+
+    return frame_ids, rate_inverse
+
+
+# frame index (<recording_id>.index.npz), built by sample_frame.py:
+#   frame_ids, signatures (luminance histograms of downsampled frames),
+#   & phashes (64-bit perceptual hashes)
+SIGNATURE_SIZE = (32, 18)
+SIGNATURE_GRID = 2  # 2x2 regions, to tell apart frames w/ the same histogram
+SIGNATURE_BINS = 16
+
+
+def compute_signatures(images: np.ndarray) -> np.ndarray:
+    """
+    compute per-frame signatures, vectorized over frames
+    * images: grayscale frames, uint8 array of (#frames, height, width)
+    * return: normalized histograms of each region, (#frames, grid^2 * bins)
+
+    """
+    num_images, height, width = images.shape
+    num_bins = SIGNATURE_GRID**2 * SIGNATURE_BINS
+    rows = np.arange(height) * SIGNATURE_GRID // height
+    cols = np.arange(width) * SIGNATURE_GRID // width
+    regions = (rows[:, None] * SIGNATURE_GRID + cols[None, :]) * SIGNATURE_BINS
+    # bin id of each pixel, e.g., frame 1, region 2, bin 3 => 1*64 + 2*16 + 3
+    keys = (
+        images.astype(np.int64) * SIGNATURE_BINS // 256
+        + regions[None]
+        + np.arange(num_images)[:, None, None] * num_bins
+    )
+    counts = np.bincount(keys.ravel(), minlength=num_images * num_bins)
+    signatures = counts.reshape(num_images, num_bins).astype(np.float32)
+    return signatures / (height * width / SIGNATURE_GRID**2)
+
+
+PHASH_SIZE = 32  # frames are downsampled to 32x32, & 8x8 lowest frequencies are kept
+
+
+def compute_phashes(images: np.ndarray) -> np.ndarray:
+    """
+    compute perceptual hashes (DCT-based), vectorized over frames
+    * images: grayscale frames, uint8 array of (#frames, 32, 32)
+    * return: 64-bit hashes, uint8 array of (#frames, 8)
+
+    """
+    k = np.arange(PHASH_SIZE)
+    dct = np.cos(np.pi * (2 * k[None, :] + 1) * k[:8, None] / (2 * PHASH_SIZE))
+    coefficients = (dct @ images.astype(np.float32) @ dct.T).reshape(len(images), -1)
+    # each bit: if a frequency is above the median (w/o the dc term)
+    bits = coefficients > np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1)
+
+
+def dedup_frames(phashes: np.ndarray, threshold: int) -> list[int]:
+    """
+    return indices of frames after collapsing near-duplicates
+
+    note:
+    * a run of frames within threshold (hamming distance) is collapsed into
+      its last frame, so that the last frame is always kept
+    * compared w/ the last kept frame, to avoid drifting over gradual changes
+
+    """
+    if len(phashes) == 0:
+        return []
+    # #set bits of each byte value, for hamming distance
+    popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(1)
+    indices = [len(phashes) - 1]
+    for idx in range(len(phashes) - 2, -1, -1):
+        distance = popcount[np.bitwise_xor(phashes[idx], phashes[indices[-1]])].sum()
+        if distance > threshold:
+            indices.append(idx)
+    return indices[::-1]
+
+
+def load_frame_index(filepath: Path) -> Optional[dict[str, np.ndarray]]:
+    if not filepath.exists():
+        return None
+    with np.load(filepath) as data:
+        return {k: data[k] for k in data.files}
+
+
+def sample_frame_ids_adaptive(
+    frame_ids: list[int],
+    signatures: np.ndarray,
+    max_frames: int,
+    uniform_weight: float = 0.3,
+) -> list[int]:
+    """
+    sample at most max_frames frame ids, more where the scene changes more
+
+    note:
+    * change of each frame: L1 distance of signatures from the previous frame
+    * frames are picked at equal steps of cumulative change, so that static
+      scenes get few frames
+    * uniform_weight: share of the budget spread uniformly over time, so that
+      a long static scene is still covered
+    * the last frame is always included, as in sample_frame_ids()
+
+    """
+    if len(frame_ids) <= max_frames:
+        return list(frame_ids)
+
+    changes = np.abs(np.diff(signatures, axis=0)).sum(axis=1)
+    changes = changes / max(changes.sum(), 1e-6)
+    changes = (1 - uniform_weight) * changes + uniform_weight / len(changes)
+    cumulative = np.concatenate([[0.0], np.cumsum(changes)])
+
+    # e.g., max_frames=4 => targets at 1/4, 2/4, 3/4, 4/4 of the total change
+    targets = cumulative[-1] * np.arange(1, max_frames + 1) / max_frames
+    indices = np.searchsorted(cumulative, targets).clip(0, len(frame_ids) - 1)
+    indices = set(indices.tolist())
+    indices.add(len(frame_ids) - 1)
+
+    # fill the budget w/ the largest changes, if some targets hit the same frame
+    for index in np.argsort(-changes, kind="stable") + 1:
+        if len(indices) >= max_frames:
+            break
+        indices.add(int(index))
+
+    return [frame_ids[x] for x in sorted(indices)]
@@ -7,10 +7,14 @@ session:
 """
 
 from flask import Flask, render_template, request, redirect, url_for, session
-import json
 import logging
 from pathlib import Path
 import os
+import sys
+
+# shared JSON codec in src/
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from json_codec import load_json, save_json  # noqa: E402
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
@@ -31,12 +35,10 @@ def load_data() -> list:
     # check if annotation is in progress
     filepath_output = Path(os.getenv("FILEPATH_OUTPUT"))
     if filepath_output.exists():
-        with open(filepath_output, "r") as f:
-            examples = json.load(f)
+        examples = load_json(filepath_output)
     else:
         filepath_input = Path(os.getenv("FILEPATH_INPUT"))
-        with open(filepath_input, "r") as f:
-            examples = json.load(f)
+        examples = load_json(filepath_input)
     return examples
 
 
@@ -72,9 +74,9 @@ def save_data(examples: list) -> None:
     filepath = Path(os.getenv("FILEPATH_OUTPUT"))
     if not filepath.parent.exists():
         filepath.parent.mkdir(parents=True)
-    with open(filepath, "w") as f:
-        json.dump(examples, f, indent=4)
-        f.write("\n")
+    # PRETTY=1 (or true) for indented output
+    pretty = os.getenv("PRETTY", "").lower() in {"1", "true"}
+    save_json(examples, filepath, pretty=pretty)
 
 
 @app.route("/", methods=["GET"])